@@ -20,11 +20,27 @@
 
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 
 #define smapi_dir "/sys/devices/platform/smapi"
 
 enum BatteryState { IDLE, CHARGING, DISCHARGING };
 
+const char *ac_props[] = { "ac_connected", NULL };
+const char *battery_props[] = {
+    "installed",
+    "state",
+    "remaining_percent",
+    "power_avg",
+    "power_now",
+    "remaining_capacity",
+    "last_full_capacity",
+    "design_capacity",
+    "force_discharge",
+    "inhibit_charge_minutes",
+    NULL
+};
+
 int
 read_battery_prop(int battery_id, const char *property)
 {
@@ -93,8 +109,25 @@ write_battery_prop(int battery_id, const char *property, const char *value)
     free(buf);
 }
 
+void
+print_battery_props(int battery_id, const char **props)
+{
+    int i;
+    for(i=0; props[i] != NULL; i++)
+        printf("%d %s %d\n",
+          battery_id, props[i], read_battery_prop(battery_id, props[i]));
+}
+
 int main( int argc, const char* argv[] )
 {
+    if(argc == 2 && strcmp(argv[1], "-a") == 0)
+    {
+        print_battery_props(-1, ac_props);
+        print_battery_props(0, battery_props);
+        print_battery_props(1, battery_props);
+        exit(0);
+    }
+
     if((argc < 4) ||
        (argc == 4 && strcmp(argv[1], "-g") != 0) ||
        (argc == 5 && strcmp(argv[1], "-s") != 0) ||
@@ -103,9 +136,12 @@ int main( int argc, const char* argv[] )
     {
         fprintf(stderr,
           "Usage:\n"
+          "  %s -a\n"
+          "    print every property of the AC adapter, BAT0 and BAT1,\n"
+          "    one \"BATT_ID BATT_PROP VALUE\" per line (BATT_ID is -1 for AC)\n"
           "  %s -g BATT_ID BATT_PROP\n"
           "  %s -s BATT_ID BATT_PROP VALUE\n",
-          argv[0], argv[0]);
+          argv[0], argv[0], argv[0]);
         exit(1);
     }
 
@@ -21,6 +21,7 @@
 
 from prefs import State
 from subprocess import Popen
+from stats import getStats
 import os
 import re
 import sys
@@ -53,6 +54,7 @@ class Actions():
         sys.stderr.write("using led pattern: " + str(self.ledPattern) + "\n")
         nullFile = open('/dev/null', 'w')
         if self.ledPattern != []:
+          getStats().count('subprocesses')
           Popen([LED_BATT_EXEC] + self.ledPattern, stdout=nullFile)
         nullFile.close()
   def calculateLedPattern(self):
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+#offline simulator for the charge/discharge balancing strategies
+#  drives the real BattBalance with a two-battery model on a fake clock
+#  usage: balancesim.py [--days=N] [--tick=SEC] [--latency=SEC] [--seed=N]
+#                       [--strategies=CHARGE:DISCHARGE,...] [PREF=VALUE ...]
+
+from prefs import (
+  Prefs, State, ChargeStrategy, DischargeStrategy, BalanceInterface)
+from battbalance import (
+  BattBalance, CHARGE_BEHAVIOUR_INHIBIT_CHARGE, CHARGE_BEHAVIOUR_FORCE_DISCHARGE)
+from snapshot import BattSample, StatusSnapshot
+from stats import formatTable
+import math
+import os
+import random
+import sys
+import time
+
+DEFAULT_DAYS = 7
+DEFAULT_TICK = 10
+DEFAULT_LATENCY = 2
+DEFAULT_SEED = 1
+
+#two-battery thinkpad: internal battery plus a bigger slice/ultrabay battery
+#  design mWh, internal resistance ohms, initial state of charge
+SIM_BATTERIES = [
+  (57000, 0.15, 0.90),
+  (72000, 0.12, 0.60),
+]
+CHARGE_MAX_MW = 45000
+#constant current up to this state of charge, then tapering to 0 at full
+CHARGE_TAPER_SOC = 0.8
+#fraction of capacity lost per full equivalent cycle (~20% at 1000 cycles)
+FADE_PER_CYCLE = 0.0002
+#hours on battery, then hours on AC, repeating
+BATT_HOURS = 6
+AC_HOURS = 18
+LOAD_MW = 11000
+
+class SimClock():
+  def __init__(self):
+    self.now = 0.0
+  def __call__(self):
+    return self.now
+
+class SimBattery():
+  def __init__(self, batt_id, designMwh, resistance, soc):
+    self.batt_id = batt_id
+    self.designMwh = designMwh
+    self.capacityMwh = float(designMwh)
+    self.energyMwh = designMwh * soc
+    self.resistance = resistance
+    self.inhibit = False
+    self.forceDischarge = False
+    self.state = State.IDLE
+    self.powerMw = 0
+    self.throughputMwh = 0.0
+    self.lossMwh = 0.0
+  def getSoc(self):
+    return self.energyMwh / self.capacityMwh
+  def getVoltage(self):
+    #open circuit voltage of a 3-cell li-ion pack: steep near empty
+    soc = max(min(self.getSoc(), 1.0), 0.0)
+    return 3 * (3.3 + 0.85 * soc - 0.25 * math.exp(-15 * soc))
+  def getLossMw(self, powerMw):
+    amps = powerMw / 1000.0 / self.getVoltage()
+    return amps * amps * self.resistance * 1000.0
+  def addEnergy(self, mwh):
+    self.energyMwh = max(min(self.energyMwh + mwh, self.capacityMwh), 0.0)
+    self.throughputMwh += abs(mwh)
+    self.capacityMwh -= (FADE_PER_CYCLE * self.designMwh
+      * abs(mwh) / (2.0 * self.designMwh))
+  def discharge(self, loadMw, dt):
+    lossMw = self.getLossMw(loadMw)
+    self.lossMwh += lossMw * dt / 3600.0
+    self.addEnergy(-(loadMw + lossMw) * dt / 3600.0)
+    self.state = State.DISCHARGING
+    self.powerMw = -int(loadMw + lossMw)
+  def charge(self, dt):
+    soc = self.getSoc()
+    powerMw = CHARGE_MAX_MW * min(1.0, (1.0 - soc) / (1.0 - CHARGE_TAPER_SOC))
+    lossMw = self.getLossMw(powerMw)
+    self.lossMwh += lossMw * dt / 3600.0
+    self.addEnergy((powerMw - lossMw) * dt / 3600.0)
+    self.state = State.CHARGING
+    self.powerMw = int(powerMw)
+  def rest(self):
+    self.state = State.IDLE
+    self.powerMw = 0
+  def getCycles(self):
+    return self.throughputMwh / (2.0 * self.designMwh)
+
+class SimLaptop():
+  def __init__(self, rng):
+    self.rng = rng
+    self.batts = []
+    for (i, (designMwh, resistance, soc)) in enumerate(SIM_BATTERIES):
+      self.batts.append(SimBattery(i, designMwh, resistance, soc))
+    self.loadMw = LOAD_MW
+    self.deadSeconds = 0
+    self.switches = 0
+  def isACConnected(self, t):
+    hour = (t / 3600.0) % (BATT_HOURS + AC_HOURS)
+    return hour >= BATT_HOURS
+  def nextLoad(self):
+    #random walk around LOAD_MW, between half and double
+    self.loadMw += self.rng.gauss(0, LOAD_MW * 0.05)
+    self.loadMw = max(min(self.loadMw, 2 * LOAD_MW), 0.5 * LOAD_MW)
+    return self.loadMw
+  def step(self, t, dt):
+    for batt in self.batts:
+      batt.rest()
+    if self.isACConnected(t):
+      #the EC charges one battery at a time, lowest id first
+      for batt in self.batts:
+        if not batt.inhibit and batt.getSoc() < 0.995:
+          batt.charge(dt)
+          break
+    else:
+      #forced battery first, otherwise the EC drains the highest id first
+      load = self.nextLoad()
+      nonEmpty = [batt for batt in self.batts if batt.energyMwh > 0]
+      forced = [batt for batt in nonEmpty if batt.forceDischarge]
+      if len(forced) > 0:
+        forced[0].discharge(load, dt)
+      elif len(nonEmpty) > 0:
+        nonEmpty[-1].discharge(load, dt)
+      else:
+        self.deadSeconds += dt
+  def apply(self, key, val):
+    (batt_id, prop) = key
+    batt = self.batts[batt_id]
+    inhibit = batt.inhibit
+    force = batt.forceDischarge
+    if prop == 'inhibit_charge_minutes' or prop == 'IC':
+      inhibit = val != '0'
+    elif prop == 'force_discharge' or prop == 'FD':
+      force = val != '0'
+    elif prop == 'charge_behaviour':
+      inhibit = val == CHARGE_BEHAVIOUR_INHIBIT_CHARGE
+      force = val == CHARGE_BEHAVIOUR_FORCE_DISCHARGE
+    if inhibit != batt.inhibit or force != batt.forceDischarge:
+      self.switches += 1
+    batt.inhibit = inhibit
+    batt.forceDischarge = force
+
+#same interface as CommandExecutor, applied to the model after a latency
+class SimExecutor():
+  def __init__(self, laptop, clock, latency):
+    self.laptop = laptop
+    self.clock = clock
+    self.latency = latency
+    self.pending = []
+    self.finished = []
+    self.commands = 0
+  def submit(self, key, val, fct, args):
+    self.commands += 1
+    self.pending = [cmd for cmd in self.pending if cmd[1] != key]
+    self.pending.append((self.clock() + self.latency, key, val))
+  def run(self):
+    now = self.clock()
+    for cmd in [cmd for cmd in self.pending if cmd[0] <= now]:
+      (_, key, val) = cmd
+      self.laptop.apply(key, val)
+      self.finished.append((key, val, True))
+      self.pending.remove(cmd)
+  def popFinished(self):
+    finished = self.finished
+    self.finished = []
+    return finished
+
+#stands in for BattStatus: only what BattBalance uses
+class SimBattStatus():
+  def __init__(self, prefs, laptop, clock):
+    self.prefs = prefs
+    self.laptop = laptop
+    self.clock = clock
+    self.snapshot = None
+  def refresh(self):
+    batts = []
+    for batt in self.laptop.batts:
+      batts.append(BattSample(batt.batt_id, True, batt.state,
+        int(100 * batt.getSoc()), batt.powerMw, batt.powerMw,
+        batt.energyMwh, batt.capacityMwh, batt.designMwh,
+        batt.forceDischarge, 1 if batt.inhibit else 0))
+    self.snapshot = StatusSnapshot(self.prefs,
+      self.laptop.isACConnected(self.clock()), batts)
+  def reportBalanceCommands(self, results):
+    pass
+
+class SimResult():
+  def __init__(self, chargeStrategy, dischargeStrategy):
+    self.chargeStrategy = chargeStrategy
+    self.dischargeStrategy = dischargeStrategy
+  def getRow(self):
+    return [
+      self.chargeStrategy + ':' + self.dischargeStrategy,
+      str(self.switches),
+      str(self.commands),
+      str(self.suppressed),
+      "%d%%" % self.finalImbalance,
+      "%.1f%%" % self.meanImbalance,
+      ' '.join("%.1f" % c for c in self.cycles),
+      "%.1f" % self.lossWh,
+      "%.1f" % self.deadHours,
+    ]
+
+def simulate(prefs, days, tick, latency, seed):
+  rng = random.Random(seed)
+  clock = SimClock()
+  laptop = SimLaptop(rng)
+  status = SimBattStatus(prefs, laptop, clock)
+  executor = SimExecutor(laptop, clock, latency)
+  balance = BattBalance(prefs, status, executor=executor, clock=clock)
+  balance.chargeGovernor.verbose = False
+  balance.dischargeGovernor.verbose = False
+
+  result = SimResult(prefs['chargeStrategy'], prefs['dischargeStrategy'])
+  imbalanceSum = 0.0
+  end = days * 86400
+  while clock.now < end:
+    executor.run()
+    laptop.step(clock.now, tick)
+    status.refresh()
+    balance.update()
+    pers = [batt.remaining_percent for batt in status.snapshot.batts]
+    imbalanceSum += (max(pers) - min(pers)) * tick
+    clock.now += tick
+
+  result.switches = laptop.switches
+  result.commands = executor.commands
+  result.suppressed = (balance.chargeGovernor.suppressed
+    + balance.dischargeGovernor.suppressed)
+  result.finalImbalance = max(pers) - min(pers)
+  result.meanImbalance = imbalanceSum / clock.now
+  result.cycles = [batt.getCycles() for batt in laptop.batts]
+  result.lossWh = sum(batt.lossMwh for batt in laptop.batts) / 1000.0
+  result.deadHours = laptop.deadSeconds / 3600.0
+  return result
+
+def getAllStrategies():
+  strategies = []
+  for charge in ChargeStrategy.names:
+    for discharge in DischargeStrategy.names:
+      strategies.append((charge, discharge))
+  return strategies
+
+def usage():
+  return ("Usage:\n"
+    + "  " + sys.argv[0] + " [OPTS] [PREF=VALUE ...]\n"
+    + "    --days=N          simulated days (default " + str(DEFAULT_DAYS) + ")\n"
+    + "    --tick=SEC        seconds between updates (default " + str(DEFAULT_TICK) + ")\n"
+    + "    --latency=SEC     delay before a command reaches the battery"
+    + " (default " + str(DEFAULT_LATENCY) + ")\n"
+    + "    --seed=N          random seed for the load (default " + str(DEFAULT_SEED) + ")\n"
+    + "    --strategies=CHARGE:DISCHARGE,...\n"
+    + "                      default is every combination\n"
+    + "    PREF=VALUE        override a pref, e.g.: dischargeLeapfrogThreshold=8\n"
+    + "\n"
+    + "  columns: hardware mode switches, balance commands sent,\n"
+    + "    switches suppressed by hysteresis/dwell/rate limit,\n"
+    + "    final and mean percent imbalance, equivalent full cycles per battery,\n"
+    + "    resistive loss in Wh, hours with both batteries empty\n"
+    )
+
+def main():
+  days = DEFAULT_DAYS
+  tick = DEFAULT_TICK
+  latency = DEFAULT_LATENCY
+  seed = DEFAULT_SEED
+  strategies = getAllStrategies()
+  overrides = []
+  for arg in sys.argv[1:]:
+    (key, _, val) = arg.partition('=')
+    if key == '--days':
+      days = float(val)
+    elif key == '--tick':
+      tick = float(val)
+    elif key == '--latency':
+      latency = float(val)
+    elif key == '--seed':
+      seed = int(val)
+    elif key == '--strategies':
+      strategies = [tuple(s.upper().split(':')) for s in val.split(',')]
+    elif not key.startswith('-') and val != '':
+      overrides.append((key, val))
+    else:
+      print(usage())
+      return 1
+  if days <= 0 or tick <= 0:
+    print(usage())
+    return 1
+
+  if 'HOME' not in os.environ:
+    os.environ['HOME'] = '/'
+  rows = [['strategy', 'switches', 'commands', 'suppressed',
+    'imbalance', 'mean', 'cycles', 'lossWh', 'deadH']]
+  start = time.time()
+  for (charge, discharge) in strategies:
+    prefs = Prefs()
+    prefs['balanceInterface'] = BalanceInterface.SMAPI
+    for (key, val) in overrides:
+      prefs[key] = val
+    prefs['chargeStrategy'] = charge
+    prefs['dischargeStrategy'] = discharge
+    rows.append(simulate(prefs, days, tick, latency, seed).getRow())
+  print(formatTable(rows))
+  sys.stderr.write("%d strategies x %g days in %.1fs\n"
+    % (len(strategies), days, time.time() - start))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
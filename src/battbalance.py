@@ -20,8 +20,15 @@
 ##########################################################################
 
 from prefs import DischargeStrategy, ChargeStrategy, BalanceInterface
+from collections import OrderedDict, deque
+import errno
+import os
+import re
 import sys
+import threading
+import time
 from subprocess import Popen
+from stats import getStats
 
 CHARGE_BEHAVIOUR_AUTO = 'auto'
 CHARGE_BEHAVIOUR_INHIBIT_CHARGE = 'inhibit-charge'
@@ -30,172 +37,473 @@ CHARGE_BEHAVIOUR_FORCE_DISCHARGE = 'force-discharge'
 THINKPAD_ACPI_CHARGE = '/usr/bin/thinkpad-acpi-charge'
 TPACPI_BAT = 'tpacpi-bat'
 SMAPI_BATTACCESS = '/usr/bin/smapi-battaccess'
+POWER_SUPPLY_DIR = '/sys/class/power_supply'
+
+def charge_behaviour_path(batt_id):
+  return POWER_SUPPLY_DIR + '/BAT' + str(batt_id) + '/charge_behaviour'
+
+def read_charge_behaviour(batt_id):
+  getStats().count('sysfsReads')
+  try:
+    f = open(charge_behaviour_path(batt_id), 'r')
+    s = f.read()
+    f.close()
+  except (IOError, OSError):
+    return None
+  return parse_charge_behaviour(s)
+
+def parse_charge_behaviour(s):
+  #e.g.: "auto [inhibit-charge] force-discharge"
+  m = re.search(r'\[([a-z\-]+)\]', s)
+  if m == None:
+    return None
+  return m.group(1)
+
+def write_charge_behaviour(batt_id, val):
+  #returns None if the file is not writable by this process
+  try:
+    fd = os.open(charge_behaviour_path(batt_id), os.O_WRONLY)
+  except OSError as e:
+    if e.errno in [errno.EACCES, errno.EPERM, errno.EROFS]:
+      return None
+    raise
+  try:
+    os.write(fd, (val + "\n").encode('utf-8'))
+  finally:
+    os.close(fd)
+  return read_charge_behaviour(batt_id) == val
 
 def set_thinkpad_acpi_charge_behaviour(batt_id, val):
   try:
     sys.stderr.write("setting BAT" + str(batt_id) + "/charge_behaviour => " + val + "\n")
+    ok = write_charge_behaviour(batt_id, val)
+    if ok != None:
+      if not ok:
+        sys.stderr.write("BAT" + str(batt_id) + "/charge_behaviour != " + val + "\n")
+      return ok
+    getStats().count('subprocesses')
     p = Popen([THINKPAD_ACPI_CHARGE, '--charge', str(batt_id), val])
-    p.wait()
+    return p.wait() == 0
   except:
     msg = 'Could not set charge_behaviour=' + val + ' on bat ' + str(batt_id)
     sys.stderr.write(msg + "\n")
+    return False
 
 def smapi_set(batt_id, prop, val):
   try:
     sys.stderr.write("setting BAT" + str(batt_id) + "/" + prop + " => " + val + "\n")
+    getStats().count('subprocesses')
     p = Popen([SMAPI_BATTACCESS, '-s', str(batt_id), prop, val])
-    p.wait()
+    return p.wait() == 0
   except:
     msg = 'Could not set ' + prop + '=' + val + ' on bat ' + str(batt_id)
     sys.stderr.write(msg + "\n")
+    return False
 
 def tpacpi_set(batt_id, method, val=None):
   try:
     sys.stderr.write("setting BAT" + str(batt_id) + "/" + method + " => " + val + "\n")
+    getStats().count('subprocesses')
     p = Popen([TPACPI_BAT, '-s', method, str(batt_id), val])
-    p.wait()
+    return p.wait() == 0
   except:
-    msg = 'Could not set ' + method + '=' + val + ' on bat ' + str(batt_id)
+    msg = 'Could not set ' + method + '=' + str(val) + ' on bat ' + str(batt_id)
     sys.stderr.write(msg + "\n")
+    return False
+
+class CommandExecutor():
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.pending = OrderedDict()
+    self.running = None
+    self.finished = []
+    self.thread = None
+  def submit(self, key, val, fct, args):
+    self.cond.acquire()
+    try:
+      if self.running == (key, val):
+        #the worker is setting this right now, anything queued is stale
+        self.pending.pop(key, None)
+      else:
+        #replaces a queued value, keeping its place in line
+        self.pending[key] = (val, fct, args)
+      if self.thread == None:
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.cond.notify()
+    finally:
+      self.cond.release()
+  def popFinished(self):
+    self.cond.acquire()
+    try:
+      finished = self.finished
+      self.finished = []
+      return finished
+    finally:
+      self.cond.release()
+  def run(self):
+    while True:
+      self.cond.acquire()
+      try:
+        while len(self.pending) == 0:
+          self.cond.wait()
+        (key, (val, fct, args)) = self.pending.popitem(last=False)
+        self.running = (key, val)
+      finally:
+        self.cond.release()
+
+      try:
+        ok = fct(*args)
+      except Exception as e:
+        sys.stderr.write("balance command failed: " + str(e) + "\n")
+        ok = False
+
+      self.cond.acquire()
+      try:
+        self.running = None
+        self.finished.append((key, val, ok))
+      finally:
+        self.cond.release()
+
+#gates changes of the battery a strategy picks, so a decision near a
+#  threshold does not flip the hardware back and forth every update
+# a switch needs all of:
+#   balanceMinDwell ms since the last switch
+#   some battery percent moved balanceHysteresis% since the last switch
+#   fewer than balanceMaxSwitchesPerHour switches in the last hour
+# otherwise the current choice is kept and the switch counted as suppressed
+# letting go (target None) always goes through, so nothing stays forced
+class SwitchGovernor():
+  def __init__(self, prefs, name):
+    self.prefs = prefs
+    self.name = name
+    self.current = None
+    self.lastSwitch = None
+    self.lastPercents = None
+    self.switchTimes = deque()
+    self.switches = 0
+    self.suppressed = 0
+    self.verbose = True
+  def reset(self):
+    #the strategy let go (AC change, too few batteries, system strategy)
+    self.current = None
+    self.lastPercents = None
+  def isDwellOver(self, now):
+    minDwell = self.prefs['balanceMinDwell']
+    return (minDwell <= 0 or self.lastSwitch == None
+      or now - self.lastSwitch >= minDwell / 1000.0)
+  def isOutsideBand(self, percents):
+    hysteresis = self.prefs['balanceHysteresis']
+    if hysteresis <= 0 or self.lastPercents == None:
+      return True
+    if set(percents.keys()) != set(self.lastPercents.keys()):
+      return True
+    for batt_id in percents:
+      if abs(percents[batt_id] - self.lastPercents[batt_id]) >= hysteresis:
+        return True
+    return False
+  def isUnderRate(self, now):
+    maxSwitches = self.prefs['balanceMaxSwitchesPerHour']
+    while len(self.switchTimes) > 0 and now - self.switchTimes[0] >= 3600:
+      self.switchTimes.popleft()
+    return maxSwitches <= 0 or len(self.switchTimes) < maxSwitches
+  def decide(self, target, percents, now):
+    if self.current != None and self.current not in percents:
+      #the battery being held went away
+      self.reset()
+    if target == self.current:
+      return target
+    if target != None and (not self.isDwellOver(now)
+        or not self.isOutsideBand(percents)
+        or not self.isUnderRate(now)):
+      self.suppressed += 1
+      return self.current
+    self.current = target
+    self.lastSwitch = now
+    self.lastPercents = percents
+    self.switchTimes.append(now)
+    self.switches += 1
+    if self.verbose:
+      self.logSwitch(target)
+    return target
+  def logSwitch(self, target):
+    if target == None:
+      targetName = 'none'
+    else:
+      targetName = 'BAT' + str(target)
+    sys.stderr.write("balance " + self.name + " => " + targetName
+      + " (" + str(self.switches) + " switches"
+      + ", " + str(self.suppressed) + " suppressed)" + "\n")
+  def getCounts(self):
+    return (self.switches, self.suppressed)
+
+#stands in for CommandExecutor when the batteries are not this machine's
+#  (replay, sysfsRoot), so decisions are still made but only logged
+class DryRunExecutor():
+  def __init__(self):
+    self.finished = []
+  def submit(self, key, val, fct, args):
+    (batt_id, prop) = key
+    sys.stderr.write("dry run: BAT" + str(batt_id) + "/" + prop
+      + " => " + val + "\n")
+    self.finished.append((key, val, True))
+  def popFinished(self):
+    finished = self.finished
+    self.finished = []
+    return finished
+
+def getInstalled(snapshot):
+  return [batt for batt in snapshot.batts if batt.isInstalled()]
+
+#first battery with the highest/lowest percent
+def getHighest(batts):
+  return max(batts, key=lambda batt: batt.remaining_percent)
+def getLowest(batts):
+  return min(batts, key=lambda batt: batt.remaining_percent)
+def getPercents(batts):
+  return dict((batt.batt_id, batt.remaining_percent) for batt in batts)
 
 class BattBalance():
-  def __init__(self, prefs, battStatus):
+  def __init__(self, prefs, battStatus, executor=None, clock=None):
     self.prefs = prefs
     self.battStatus = battStatus
+    if executor == None:
+      executor = CommandExecutor()
+    if clock == None:
+      clock = time.time
+    self.executor = executor
+    self.liveExecutor = executor
+    self.clock = clock
+    #write-through cache of the last value commanded
+    #  (batt_id, prop) => (val, time)
+    self.commanded = dict()
+    self.chargeGovernor = SwitchGovernor(prefs, 'charge')
+    self.dischargeGovernor = SwitchGovernor(prefs, 'force-discharge')
+    #charge_behaviour per battery decided so far this update, or None
+    self.behaviours = None
 
   def update(self):
-    self.perhaps_inhibit_charge()
-    self.perhaps_force_discharge()
+    results = self.executor.popFinished()
+    for (key, val, ok) in results:
+      if not ok:
+        self.commanded.pop(key, None)
+    self.battStatus.reportBalanceCommands(results)
+    self.behaviours = OrderedDict()
+    try:
+      self.perhaps_inhibit_charge()
+      self.perhaps_force_discharge()
+      behaviours = self.behaviours
+    finally:
+      self.behaviours = None
+    for (batt_id, val) in behaviours.items():
+      self.setChargeBehaviour(batt_id, val)
+
+  def getDecisionMargin(self):
+    snapshot = self.battStatus.snapshot
+    batts = getInstalled(snapshot)
+    if len(batts) < 2:
+      return None
+    pers = sorted(batt.remaining_percent for batt in batts)
+    spread = pers[-1] - pers[0]
+    margins = []
+    if snapshot.isACConnected():
+      strategy = self.prefs['chargeStrategy']
+      if strategy == ChargeStrategy.LEAPFROG:
+        threshold = self.prefs['chargeLeapfrogThreshold']
+        margins.append(abs(spread - threshold))
+      elif strategy == ChargeStrategy.CHASING:
+        margins.append(pers[1] - pers[0])
+      elif strategy == ChargeStrategy.BRACKETS:
+        for bracket in self.prefs['chargeBrackets']:
+          for per in pers:
+            margins.append(abs(per - bracket))
+    else:
+      strategy = self.prefs['dischargeStrategy']
+      if strategy == DischargeStrategy.LEAPFROG:
+        threshold = self.prefs['dischargeLeapfrogThreshold']
+        margins.append(abs(spread - threshold))
+        for per in pers:
+          margins.append(abs(per - threshold))
+      elif strategy == DischargeStrategy.CHASING:
+        margins.append(pers[-1] - pers[-2])
+    if len(margins) == 0:
+      return None
+    return min(margins)
+
+  def setDryRun(self, dryRun):
+    if dryRun and self.executor == self.liveExecutor:
+      self.executor = DryRunExecutor()
+    elif not dryRun:
+      self.executor = self.liveExecutor
+    self.commanded = dict()
+
+  def isFresh(self, commandTime, now):
+    interval = self.prefs['balanceVerifyInterval']
+    return interval > 0 and now - commandTime < interval / 1000.0
+  def getCommanded(self, batt_id, prop):
+    #None if never commanded, failed, or due to be checked against hardware
+    cached = self.commanded.get((batt_id, prop))
+    if cached == None or not self.isFresh(cached[1], self.clock()):
+      return None
+    return cached[0]
+  def submit(self, key, val, fct, args):
+    now = self.clock()
+    cached = self.commanded.get(key)
+    if cached != None and cached[0] == val and self.isFresh(cached[1], now):
+      return
+    self.commanded[key] = (val, now)
+    self.executor.submit(key, val, fct, args)
+
+  #thinkpad_acpi has one charge_behaviour file for both inhibit-charge and
+  #  force-discharge, so both decisions of an update are merged into one
+  #  command per battery, with anything beating auto
+  #  (e.g.: on AC plug-in, inhibit-charge wins over ending force-discharge)
+  def mergeChargeBehaviour(self, batt_id, val):
+    if self.behaviours == None:
+      self.setChargeBehaviour(batt_id, val)
+    elif val != CHARGE_BEHAVIOUR_AUTO or batt_id not in self.behaviours:
+      self.behaviours[batt_id] = val
+  def setChargeBehaviour(self, batt_id, val):
+    self.submit((batt_id, 'charge_behaviour'), val,
+      set_thinkpad_acpi_charge_behaviour, [batt_id, val])
+
+  def setInhibitCharge(self, batt_id, inhibit):
+    interface = self.prefs['balanceInterface']
+    if interface == BalanceInterface.THINKPAD_ACPI:
+      if inhibit:
+        val = CHARGE_BEHAVIOUR_INHIBIT_CHARGE
+      else:
+        val = CHARGE_BEHAVIOUR_AUTO
+      self.mergeChargeBehaviour(batt_id, val)
+    elif interface == BalanceInterface.SMAPI:
+      val = '1' if inhibit else '0'
+      self.submit((batt_id, 'inhibit_charge_minutes'), val,
+        smapi_set, [batt_id, 'inhibit_charge_minutes', val])
+    elif interface == BalanceInterface.TPACPI:
+      val = '1' if inhibit else '0'
+      self.submit((batt_id, 'IC'), val,
+        tpacpi_set, [batt_id + 1, 'IC', val])
 
+  def setForceDischarge(self, batt_id, force):
+    interface = self.prefs['balanceInterface']
+    if interface == BalanceInterface.THINKPAD_ACPI:
+      if force:
+        val = CHARGE_BEHAVIOUR_FORCE_DISCHARGE
+      else:
+        val = CHARGE_BEHAVIOUR_AUTO
+      self.mergeChargeBehaviour(batt_id, val)
+    elif interface == BalanceInterface.SMAPI:
+      val = '1' if force else '0'
+      self.submit((batt_id, 'force_discharge'), val,
+        smapi_set, [batt_id, 'force_discharge', val])
+    elif interface == BalanceInterface.TPACPI:
+      val = '1' if force else '0'
+      self.submit((batt_id, 'FD'), val,
+        tpacpi_set, [batt_id + 1, 'FD', val])
+
+  #charge only batt_id, inhibiting charging on every other battery
   def ensure_charging(self, batt_id):
-    previnhib0 = self.battStatus.batt0.isChargeInhibited()
-    previnhib1 = self.battStatus.batt1.isChargeInhibited()
-    charge0 = self.battStatus.batt0.isCharging()
-    charge1 = self.battStatus.batt1.isCharging()
-    if batt_id == 0 and (previnhib0 or (not charge0 and not previnhib1)):
-      if self.prefs['balanceInterface'] == BalanceInterface.THINKPAD_ACPI:
-        set_thinkpad_acpi_charge_behaviour(1, CHARGE_BEHAVIOUR_INHIBIT_CHARGE)
-        set_thinkpad_acpi_charge_behaviour(0, CHARGE_BEHAVIOUR_AUTO)
-      elif self.prefs['balanceInterface'] == BalanceInterface.SMAPI:
-        smapi_set(1, 'inhibit_charge_minutes', '1')
-        smapi_set(0, 'inhibit_charge_minutes', '0')
-      elif self.prefs['balanceInterface'] == BalanceInterface.TPACPI:
-        tpacpi_set(2, 'IC', '1')
-        tpacpi_set(1, 'IC', '0')
-    elif batt_id == 1 and (previnhib1 or (not charge1 and not previnhib0)):
-      if self.prefs['balanceInterface'] == BalanceInterface.THINKPAD_ACPI:
-        set_thinkpad_acpi_charge_behaviour(0, CHARGE_BEHAVIOUR_INHIBIT_CHARGE)
-        set_thinkpad_acpi_charge_behaviour(1, CHARGE_BEHAVIOUR_AUTO)
-      elif self.prefs['balanceInterface'] == BalanceInterface.SMAPI:
-        smapi_set(0, 'inhibit_charge_minutes', '1')
-        smapi_set(1, 'inhibit_charge_minutes', '0')
-      elif self.prefs['balanceInterface'] == BalanceInterface.TPACPI:
-        tpacpi_set(1, 'IC', '1')
-        tpacpi_set(2, 'IC', '0')
+    batts = getInstalled(self.battStatus.snapshot)
+    target = None
+    othersCharging = False
+    for batt in batts:
+      if batt.batt_id == batt_id:
+        target = batt
+      elif not batt.isChargeInhibited():
+        othersCharging = True
+    if target == None:
+      return
+    if target.isChargeInhibited() or (
+        not target.isCharging() and othersCharging):
+      for batt in batts:
+        if batt.batt_id != batt_id:
+          self.setInhibitCharge(batt.batt_id, True)
+      self.setInhibitCharge(batt_id, False)
 
   def perhaps_inhibit_charge(self):
-    ac = self.battStatus.ac
-    b0 = self.battStatus.batt0
-    b1 = self.battStatus.batt1
+    snapshot = self.battStatus.snapshot
+    batts = getInstalled(snapshot)
     should_not_inhibit = (
-      not ac.isACConnected() or
-      not b0.isInstalled() or
-      not b1.isInstalled())
-    charge0 = b0.isCharging()
-    charge1 = b1.isCharging()
-    per0 = int(float(b0.remaining_percent))
-    per1 = int(float(b1.remaining_percent))
+      not snapshot.isACConnected() or
+      len(batts) < 2)
     strategy = self.prefs['chargeStrategy']
     if should_not_inhibit or strategy == ChargeStrategy.SYSTEM:
-      if b0.isChargeInhibited():
-        if self.prefs['balanceInterface'] == BalanceInterface.THINKPAD_ACPI:
-          set_thinkpad_acpi_charge_behaviour(0, CHARGE_BEHAVIOUR_AUTO)
-        elif self.prefs['balanceInterface'] == BalanceInterface.SMAPI:
-          smapi_set(0, 'inhibit_charge_minutes', '0')
-        elif self.prefs['balanceInterface'] == BalanceInterface.TPACPI:
-          tpacpi_set(1, "IC", 0)
-      if b1.isChargeInhibited():
-        if self.prefs['balanceInterface'] == BalanceInterface.THINKPAD_ACPI:
-          set_thinkpad_acpi_charge_behaviour(1, CHARGE_BEHAVIOUR_AUTO)
-        elif self.prefs['balanceInterface'] == BalanceInterface.SMAPI:
-          smapi_set(1, 'inhibit_charge_minutes', '0')
-        elif self.prefs['balanceInterface'] == BalanceInterface.TPACPI:
-          tpacpi_set(2, "IC", 0)
-    elif strategy == ChargeStrategy.LEAPFROG:
-      if per1 - per0 > self.prefs['chargeLeapfrogThreshold']:
-        self.ensure_charging(1)
-      elif per0 - per1 > self.prefs['chargeLeapfrogThreshold']:
-        self.ensure_charging(0)
+      self.chargeGovernor.reset()
+      for batt in snapshot.batts:
+        if batt.isChargeInhibited():
+          self.setInhibitCharge(batt.batt_id, False)
+      return
+
+    charge_id = self.get_charge_target(strategy, batts)
+    if charge_id != None:
+      charge_id = self.chargeGovernor.decide(
+        charge_id, getPercents(batts), self.clock())
+    if charge_id != None:
+      self.ensure_charging(charge_id)
+
+  #battery the strategy wants charged, or None to leave things as they are
+  def get_charge_target(self, strategy, batts):
+    highest = getHighest(batts)
+    lowest = getLowest(batts)
+    spread = highest.remaining_percent - lowest.remaining_percent
+    if strategy == ChargeStrategy.LEAPFROG:
+      if spread > self.prefs['chargeLeapfrogThreshold']:
+        return highest.batt_id
     elif strategy == ChargeStrategy.CHASING:
-      if per1 > per0:
-        ensure_charging(0)
-      elif per0 > per1:
-        ensure_charging(1)
+      if spread > 0:
+        return lowest.batt_id
     elif strategy == ChargeStrategy.BRACKETS:
+      #preferred battery first, then the rest in order
       prefBat = self.prefs['chargeBracketsPrefBattery']
-      unprefBat = 1 - prefBat
-      percentPref = per0 if prefBat == 0 else per1
-      percentUnpref = per0 if unprefBat == 0 else per1
+      ordered = ([batt for batt in batts if batt.batt_id == prefBat]
+        + [batt for batt in batts if batt.batt_id != prefBat])
       for bracket in self.prefs['chargeBrackets']:
-        if percentPref < bracket:
-          self.ensure_charging(prefBat)
-          break
-        elif percentUnpref < bracket:
-          self.ensure_charging(unprefBat)
-          break
+        below = [batt for batt in ordered if batt.remaining_percent < bracket]
+        if len(below) > 0:
+          return below[0].batt_id
+    return None
 
   def perhaps_force_discharge(self):
-    ac = self.battStatus.ac
-    b0 = self.battStatus.batt0
-    b1 = self.battStatus.batt1
+    snapshot = self.battStatus.snapshot
+    batts = getInstalled(snapshot)
     should_force = (
-      not ac.isACConnected() and
-      b0.isInstalled() and
-      b1.isInstalled())
-    dis0 = b0.isDischarging()
-    dis1 = b1.isDischarging()
-    per0 = int(float(b0.remaining_percent))
-    per1 = int(float(b1.remaining_percent))
-    force0 = False
-    force1 = False
+      not snapshot.isACConnected() and
+      len(batts) >= 2)
+    force_id = None
     strategy = self.prefs['dischargeStrategy']
     if not should_force or strategy == DischargeStrategy.SYSTEM:
-      force0 = False
-      force1 = False
+      self.dischargeGovernor.reset()
+      force_id = None
     elif strategy == DischargeStrategy.LEAPFROG:
       leapfrogThreshold = self.prefs['dischargeLeapfrogThreshold']
-      if dis0:
-        if per1 - per0 > leapfrogThreshold:
-          force1 = True
-        elif per0 > leapfrogThreshold:
-          force0 = True
-      elif dis1:
-        if per0 - per1 > leapfrogThreshold:
-          force0 = True
-        elif per1 > leapfrogThreshold:
-          force1 = True
-      elif per0 > leapfrogThreshold and per0 > per1:
-        force0 = True
-      elif per1 > leapfrogThreshold and per1 > per0:
-        force1 = True
+      discharging = [batt for batt in batts if batt.isDischarging()]
+      highest = getHighest(batts)
+      if len(discharging) > 0:
+        cur = discharging[0]
+        others = [batt for batt in batts if batt.batt_id != cur.batt_id]
+        best = getHighest(others)
+        if best.remaining_percent - cur.remaining_percent > leapfrogThreshold:
+          force_id = best.batt_id
+        elif cur.remaining_percent > leapfrogThreshold:
+          force_id = cur.batt_id
+      elif (highest.remaining_percent > leapfrogThreshold
+          and highest.remaining_percent > getLowest(batts).remaining_percent):
+        force_id = highest.batt_id
     elif strategy == DischargeStrategy.CHASING:
-      if per0 > per1:
-        force0 = True
-      elif per1 > per0:
-        force1 = True
-
-    prevforce0 = b0.isForceDischarge()
-    prevforce1 = b1.isForceDischarge()
-
-    if prevforce0 != force0 or prevforce1 != force1:
-      if self.prefs['balanceInterface'] == BalanceInterface.TPACPI:
-        set_thinkpad_acpi_charge_behaviour(0,
-          CHARGE_BEHAVIOUR_FORCE_DISCHARGE if force0 else CHARGE_BEHAVIOUR_AUTO)
-        set_thinkpad_acpi_charge_behaviour(1,
-          CHARGE_BEHAVIOUR_FORCE_DISCHARGE if force1 else CHARGE_BEHAVIOUR_AUTO)
-      elif self.prefs['balanceInterface'] == BalanceInterface.SMAPI:
-        smapi_set(0, 'force_discharge', '1' if force0 else '0')
-        smapi_set(1, 'force_discharge', '1' if force1 else '0')
-      elif self.prefs['balanceInterface'] == BalanceInterface.TPACPI:
-        tpacpi_set(1, 'FD', '1' if force0 else '0')
-        tpacpi_set(2, 'FD', '1' if force1 else '0')
+      highest = getHighest(batts)
+      if highest.remaining_percent > getLowest(batts).remaining_percent:
+        force_id = highest.batt_id
+
+    if should_force and strategy != DischargeStrategy.SYSTEM:
+      force_id = self.dischargeGovernor.decide(
+        force_id, getPercents(batts), self.clock())
+
+    changed = False
+    for batt in snapshot.batts:
+      if batt.isForceDischarge() != (batt.batt_id == force_id):
+        changed = True
+
+    if changed:
+      for batt in snapshot.batts:
+        self.setForceDischarge(batt.batt_id, batt.batt_id == force_id)
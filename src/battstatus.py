@@ -19,163 +19,492 @@
 # along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
 ##########################################################################
 
-from prefs import State, ChargeStrategy, DischargeStrategy, Interface
-from battbalance import BattBalance
+from prefs import (
+  State, ChargeStrategy, DischargeStrategy, Interface, BalanceInterface)
+from battbalance import (
+  BattBalance, parse_charge_behaviour,
+  CHARGE_BEHAVIOUR_INHIBIT_CHARGE, CHARGE_BEHAVIOUR_FORCE_DISCHARGE)
+from history import BattHistory, getHistoryPath
+from estimator import TimeEstimator
+from sysfsrecord import SysfsReplayer
+from snapshot import (
+  battSampleFromInfo, emptySnapshot, snapshotFromDict, StatusSnapshot)
+from stats import getStats
 import sys
 import re
 import os
+import errno
+import time
 from subprocess import Popen, PIPE
 
 SMAPI_BATTACCESS = '/usr/bin/smapi-battaccess'
+SMAPI_DIR = '/sys/devices/platform/smapi'
+SMAPI_STATES = {'idle': '0', 'charging': '1', 'discharging': '2'}
+ACPI_DIR = '/sys/class/power_supply'
+ACPI_OLD_DIR = '/proc/acpi/battery'
+ACPI_OLD_AC_PATH = '/proc/acpi/ac_adapter/AC/state'
+SYSFS_BUF_SIZE = 256
+
+#BAT0 and BAT1 are always shown, even when missing, like before
+DEFAULT_BATT_IDS = [0, 1]
+#seconds between rescans for docks/slice batteries appearing or going away
+BATT_DISCOVERY_INTERVAL = 10
+
+#quantity => charge (uAh/uA) file, energy (uWh/uW) file
+#  capacities are always reported in mWh and power in mW, as in smapi
+ACPI_CHARGE_FIELDS = [
+  ['now', 'charge_now', 'energy_now'],
+  ['full', 'charge_full', 'energy_full'],
+  ['full_design', 'charge_full_design', 'energy_full_design'],
+  ['rate', 'current_now', 'power_now'],
+]
+
+def discoverBattIds(battDir):
+  battIds = set(DEFAULT_BATT_IDS)
+  try:
+    names = os.listdir(battDir)
+  except OSError:
+    names = []
+  for name in names:
+    m = re.match(r'^BAT(\d+)$', name)
+    if m != None:
+      battIds.add(int(m.group(1)))
+  return sorted(battIds)
+
+#hardware backends, one per Interface, that create the readers
+#  root is prepended to every sysfs/procfs path, '' for this machine
+class Backend():
+  battDir = None
+  def __init__(self, prefs, root):
+    self.root = root
+  def isReal(self):
+    return self.root == ''
+  def getBattDir(self):
+    return self.root + self.battDir
+  def startCycle(self):
+    pass
+  def close(self):
+    pass
+
+class AcpiBackend(Backend):
+  battDir = ACPI_DIR
+  def newACInfo(self):
+    return ACInfoAcpi(self.root)
+  def newBattInfo(self, batt_id):
+    return BattInfoAcpi(batt_id, self.root)
+
+class SmapiBackend(Backend):
+  battDir = SMAPI_DIR
+  def __init__(self, prefs, root):
+    Backend.__init__(self, prefs, root)
+    self.smapiReader = SmapiReader(root)
+  def newACInfo(self):
+    return ACInfoSmapi(self.smapiReader)
+  def newBattInfo(self, batt_id):
+    return BattInfoSmapi(batt_id, self.smapiReader)
+  def startCycle(self):
+    self.smapiReader.startCycle()
+  def close(self):
+    self.smapiReader.files.closeAll()
+
+class AcpiOldBackend(Backend):
+  battDir = ACPI_OLD_DIR
+  def newACInfo(self):
+    return ACInfoAcpiOld(self.root)
+  def newBattInfo(self, batt_id):
+    return BattInfoAcpiOld(batt_id, self.root)
+
+#plays back a power_supply recording into a temp dir, read like acpi
+class ReplayBackend(AcpiBackend):
+  def __init__(self, prefs, root):
+    if prefs['replayFile'] == '':
+      raise Exception("interface=replay needs replayFile set in prefs")
+    self.replayer = SysfsReplayer(prefs['replayFile'], prefs['replaySpeed'])
+    AcpiBackend.__init__(self, prefs, self.replayer.root)
+  def isReal(self):
+    return False
+  def startCycle(self):
+    self.replayer.advance()
+  def close(self):
+    self.replayer.close()
+
+BACKENDS = dict()
+
+def registerBackend(interface, backendClass):
+  BACKENDS[interface] = backendClass
+
+def newBackend(prefs):
+  root = prefs['sysfsRoot'].rstrip('/')
+  return BACKENDS[prefs['interface']](prefs, root)
+
+registerBackend(Interface.ACPI, AcpiBackend)
+registerBackend(Interface.SMAPI, SmapiBackend)
+registerBackend(Interface.ACPI_OLD, AcpiOldBackend)
+registerBackend(Interface.REPLAY, ReplayBackend)
 
 class BattStatus():
   def __init__(self, prefs):
     self.prefs = prefs
     self.battBalance = BattBalance(prefs, self)
-    self.last_interface = None
+    self.backend = None
+    self.backendKey = None
+    self.failedBackendKey = None
+    self.ac = None
+    self.lastDiscovery = None
+    self.batts = []
+    self.balanceCommands = dict()
+    self.snapshot = emptySnapshot(prefs)
+    self.estimator = TimeEstimator()
+    self.history = None
+    self.historyDisabled = False
+    self.historyLastFlush = 0
   def getBattInfo(self, batt_id):
-    if batt_id == 0:
-      return self.batt0
-    elif batt_id == 1:
-      return self.batt1
-    else:
-      return None
+    return self.snapshot.getBatt(batt_id)
   def getPowerDisplay(self):
-    disp = self.prefs['displayPowerUsage'].lower()
-    if disp == 'now' and self.prefs['interface'] != Interface.SMAPI:
-      disp = 'average'
-
-    if disp == 'average':
-      p0 = int(float(self.batt0.power_avg))
-      p1 = int(float(self.batt1.power_avg))
-    elif disp == 'now':
-      p0 = int(float(self.batt0.power_now))
-      p1 = int(float(self.batt1.power_now))
-    else:
-      return ''
-
-    if p0 != 0:
-      p = p0
-    else:
-      p = p1
-    return "%.1fW" % (p/1000.0)
+    return self.snapshot.power_display
   def update(self, prefs):
-    if self.last_interface != self.prefs['interface']:
-      self.last_interface = self.prefs['interface']
-      if self.prefs['interface'] == Interface.SMAPI:
-        self.ac = ACInfoSmapi()
-        self.batt0 = BattInfoSmapi(0)
-        self.batt1 = BattInfoSmapi(1)
-      elif self.prefs['interface'] == Interface.ACPI:
-        self.ac = ACInfoAcpi()
-        self.batt0 = BattInfoAcpi(0)
-        self.batt1 = BattInfoAcpi(1)
-      elif self.prefs['interface'] == Interface.ACPI_OLD:
-        self.ac = ACInfoAcpiOld()
-        self.batt0 = BattInfoAcpiOld(0)
-        self.batt1 = BattInfoAcpiOld(1)
+    backendKey = (prefs['interface'], prefs['sysfsRoot'],
+      prefs['replayFile'], prefs['replaySpeed'])
+    if self.backendKey != backendKey and self.failedBackendKey != backendKey:
+      try:
+        backend = newBackend(prefs)
+      except Exception as e:
+        #keep reading with the old backend until the prefs change again
+        sys.stderr.write("could not switch interface: " + str(e) + "\n")
+        self.failedBackendKey = backendKey
+      else:
+        self.backendKey = backendKey
+        self.failedBackendKey = None
+        self.closeBackend()
+        self.backend = backend
+        self.ac = self.backend.newACInfo()
+        #never send balance commands to this machine for a fake sysfs
+        self.battBalance.setDryRun(not self.backend.isReal())
+        self.lastDiscovery = None
+    if self.backend == None:
+      self.snapshot = emptySnapshot(prefs)
+      return
 
+    now = time.time()
+    if (self.lastDiscovery == None
+        or now - self.lastDiscovery >= BATT_DISCOVERY_INTERVAL):
+      self.lastDiscovery = now
+      self.discoverBatts()
+
+    stats = getStats()
+    start = stats.now()
+    self.backend.startCycle()
     self.ac.update(prefs)
-    self.batt0.update(prefs)
-    self.batt1.update(prefs)
+    for batt in self.batts:
+      batt.update(prefs)
+    start = stats.stage('battStatus.read', start)
+    batts = [battSampleFromInfo(batt) for batt in self.batts]
+    estimate = self.estimator.update(now, self.ac.ac_connected, batts,
+      prefs['estimateSmoothing'])
+    self.snapshot = StatusSnapshot(prefs, self.ac.ac_connected, batts,
+      estimate)
+    #replayed or fake readings do not belong in this machine's history
+    if self.backend.isReal():
+      self.updateHistory(now)
+    start = stats.stage('battStatus.history', start)
     self.battBalance.update()
+    stats.stage('battStatus.balance', start)
+  def closeBackend(self):
+    for batt in self.batts:
+      batt.close()
+    self.batts = []
+    if self.ac != None:
+      self.ac.close()
+      self.ac = None
+    if self.backend != None:
+      self.backend.close()
+      self.backend = None
+  def newBattInfo(self, batt_id):
+    battInfo = self.backend.newBattInfo(batt_id)
+    battInfo.battBalance = self.battBalance
+    return battInfo
+  def discoverBatts(self):
+    battIds = discoverBattIds(self.backend.getBattDir())
+    if battIds == [batt.batt_id for batt in self.batts]:
+      return
+    oldBatts = dict((batt.batt_id, batt) for batt in self.batts)
+    self.batts = []
+    for batt_id in battIds:
+      batt = oldBatts.pop(batt_id, None)
+      if batt == None:
+        batt = self.newBattInfo(batt_id)
+      self.batts.append(batt)
+    for batt in oldBatts.values():
+      batt.close()
+  def getTimeDisplay(self):
+    return self.snapshot.time_display
+  def updateHistory(self, now):
+    size = self.prefs['historySize']
+    if self.history != None and size != self.history.capacity:
+      self.history.close()
+      self.history = None
+      self.historyDisabled = False
+    if size <= 0 or self.historyDisabled:
+      return
+    if self.history == None:
+      try:
+        self.history = BattHistory(getHistoryPath(), size)
+      except Exception as e:
+        sys.stderr.write("history disabled: " + str(e) + "\n")
+        self.historyDisabled = True
+        return
+
+    self.history.append(now, self.snapshot)
+    if now - self.historyLastFlush >= self.prefs['historyFlushInterval'] / 1000.0:
+      self.history.flush()
+      self.historyLastFlush = now
+  def reportBalanceCommands(self, results):
+    for (key, val, ok) in results:
+      self.balanceCommands[key] = (val, ok)
+      if not ok:
+        (batt_id, prop) = key
+        msg = 'balance command failed: BAT' + str(batt_id) + '/' + prop
+        sys.stderr.write(msg + ' => ' + val + "\n")
   def isEitherInstalled(self):
-    return self.batt0.isInstalled() or self.batt1.isInstalled()
+    return self.snapshot.either_installed
   def isEitherCharging(self):
-    return self.batt0.isCharging() or self.batt1.isCharging()
+    return self.snapshot.either_charging
   def isEitherDischarging(self):
-    return self.batt0.isDischarging() or self.batt1.isDischarging()
+    return self.snapshot.either_discharging
   def getTotalRemainingPercent(self):
-    rem_cap = 0
-    max_cap = 0
-    if self.batt0.isInstalled():
-      rem_cap = rem_cap + int(float(self.batt0.remaining_capacity))
-      max_cap = max_cap + int(float(self.batt0.last_full_capacity))
-    if self.batt1.isInstalled():
-      rem_cap = rem_cap + int(float(self.batt1.remaining_capacity))
-      max_cap = max_cap + int(float(self.batt1.last_full_capacity))
-    if max_cap == 0:
-      return 0
-    return int(100 * (float(rem_cap) / float(max_cap)))
+    return self.snapshot.total_percent
+
+class BattStatusRemote(BattStatus):
+  def __init__(self, prefs):
+    self.prefs = prefs
+    self.battBalance = None
+    self.snapshot = emptySnapshot(prefs)
+  def update(self, prefs):
+    pass
+  def loadSnapshot(self, snapshot):
+    if snapshot == None:
+      self.snapshot = emptySnapshot(self.prefs)
+    else:
+      self.snapshot = snapshotFromDict(self.prefs, snapshot)
+
+def readFile(path):
+  getStats().count('sysfsReads')
+  f = open(path, 'r')
+  s = f.read()
+  f.close()
+  return s
+
+def parseInt(s):
+  try:
+    return int(s)
+  except ValueError:
+    return 0
 
 class BattInfoBase():
   def __init__(self, batt_id):
     self.batt_id = batt_id
+    self.battBalance = None
     self.clear()
   def clear(self):
-    self.installed = '0'
+    self.installed = False
     self.state = State.IDLE
-    self.remaining_percent = '0'
-    self.power_avg = '0'
-    self.power_now = '0'
-    self.remaining_capacity = '0'
-    self.last_full_capacity = '0'
-    self.design_capacity = '0'
-    self.force_discharge = '0'
-    self.inhibit_charge_minutes = '0'
-  def isInstalled(self):
-    return self.installed == '1'
-  def isCharging(self):
-    return self.state == State.CHARGING
-  def isDischarging(self):
-    return self.state == State.DISCHARGING
-  def isForceDischarge(self):
-    return self.force_discharge == '1'
-  def isChargeInhibited(self):
-    return int(float(self.inhibit_charge_minutes)) > 0
+    self.remaining_percent = 0
+    self.power_avg = 0
+    self.power_now = 0
+    self.remaining_capacity = 0.0
+    self.last_full_capacity = 0.0
+    self.design_capacity = 0.0
+    self.force_discharge = False
+    self.inhibit_charge_minutes = 0
   def update(self, prefs):
     raise 'missing impl'
+  def close(self):
+    pass
+  def getCommanded(self, prop):
+    if self.battBalance == None:
+      return None
+    return self.battBalance.getCommanded(self.batt_id, prop)
+  def isBalanceStateNeeded(self, prefs):
+    return (prefs['dischargeStrategy'] != DischargeStrategy.SYSTEM
+      or prefs['chargeStrategy'] != ChargeStrategy.SYSTEM)
 
 class ACInfoBase():
-  def __init__(self):
+  def __init__(self, root=''):
+    self.root = root
     self.clear()
   def clear(self):
-    self.ac_connected = 0
-  def isACConnected(self):
-    return self.ac_connected == '1'
+    self.ac_connected = False
   def update(self, prefs):
     raise 'missing impl'
+  def close(self):
+    pass
 
 
 
+#reads a file from the start into buf, returning the byte count
+#  os.preadv needs python 3.7+, older ones (and py2) seek and read instead
+def preadBuf(fd, buf):
+  if hasattr(os, 'preadv'):
+    return os.preadv(fd, [buf], 0)
+  os.lseek(fd, 0, os.SEEK_SET)
+  data = os.read(fd, len(buf))
+  buf[:len(data)] = data
+  return len(data)
+
+class SysfsFileCache():
+  def __init__(self):
+    self.fds = {}
+    self.unreadable = set()
+    self.buf = bytearray(SYSFS_BUF_SIZE)
+  def open(self, path):
+    fd = self.fds.get(path)
+    if fd == None:
+      fd = os.open(path, os.O_RDONLY)
+      self.fds[path] = fd
+    return fd
+  def readBuf(self, path):
+    getStats().count('sysfsReads')
+    fd = self.open(path)
+    try:
+      return preadBuf(fd, self.buf)
+    except OSError:
+      self.close(path)
+      raise
+  def read(self, path):
+    return bytes(self.buf[:self.readBuf(path)])
+  def readInt(self, path):
+    return int(self.buf[:self.readBuf(path)])
+  def close(self, path):
+    fd = self.fds.pop(path, None)
+    if fd != None:
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+  def closeAll(self):
+    for path in list(self.fds.keys()):
+      self.close(path)
+
 class SmapiReader():
+  def __init__(self, root=''):
+    self.root = root
+    self.files = SysfsFileCache()
+    self.batch = None
+  def startCycle(self):
+    self.batch = None
+  def smapiPath(self, batt_id, prop):
+    if batt_id < 0:
+      return self.root + SMAPI_DIR + '/' + prop
+    else:
+      return self.root + SMAPI_DIR + '/BAT' + str(batt_id) + '/' + prop
+  def canRunHelper(self):
+    #smapi-battaccess only knows about this machine
+    return self.root == ''
+  def parseValue(self, prop, s):
+    s = s.decode('utf-8', 'replace').split('\n', 1)[0].strip()
+    if prop == 'state':
+      return SMAPI_STATES.get(s, '0')
+    m = re.match(r'-?\d+', s)
+    if m == None:
+      return '0'
+    return m.group(0)
+  def smapi_read(self, batt_id, prop):
+    path = self.smapiPath(batt_id, prop)
+    if path in self.files.unreadable:
+      return None
+    try:
+      return self.parseValue(prop, self.files.read(path))
+    except OSError as e:
+      if e.errno in [errno.EACCES, errno.EPERM]:
+        self.files.unreadable.add(path)
+        return None
+      #smapi-battaccess reports unreadable values as 0
+      return '0'
+  def smapi_get_batch(self):
+    if self.batch == None:
+      self.batch = dict()
+      try:
+        getStats().count('subprocesses')
+        p = Popen([SMAPI_BATTACCESS, '-a'], stdout=PIPE, stderr=PIPE)
+        (stdout, _) = p.communicate()
+        for line in stdout.decode('utf-8').splitlines():
+          cols = line.split()
+          if len(cols) == 3:
+            self.batch[(int(cols[0]), cols[1])] = cols[2]
+      except:
+        sys.stderr.write('Could not run ' + SMAPI_BATTACCESS + ' -a' + "\n")
+    return self.batch
   def smapi_get(self, batt_id, prop):
+    val = self.smapi_read(batt_id, prop)
+    if val != None:
+      return val
+    if not self.canRunHelper():
+      return '0'
+    val = self.smapi_get_batch().get((batt_id, prop))
+    if val != None:
+      return val
     try:
+      getStats().count('subprocesses')
       p = Popen([SMAPI_BATTACCESS, '-g', str(batt_id), prop], stdout=PIPE)
       (stdout, _) = p.communicate()
-      return stdout
+      return stdout.decode('utf-8').strip()
     except:
       msg = 'Could not get ' + prop + ' on bat ' + str(batt_id)
       sys.stderr.write(msg + "\n")
-      return -1
-
-class ACInfoSmapi(ACInfoBase, SmapiReader):
+      return '-1'
+  def smapi_get_all(self, batt_id, props):
+    vals = dict()
+    for prop in props:
+      vals[prop] = self.smapi_get(batt_id, prop)
+    return vals
+
+class ACInfoSmapi(ACInfoBase):
+  def __init__(self, smapiReader):
+    ACInfoBase.__init__(self)
+    self.smapiReader = smapiReader
   def update(self, prefs):
     self.clear()
-    self.ac_connected = self.smapi_get(-1, 'ac_connected')
+    self.ac_connected = parseInt(
+      self.smapiReader.smapi_get(-1, 'ac_connected')) == 1
 
-class BattInfoSmapi(BattInfoBase, SmapiReader):
+class BattInfoSmapi(BattInfoBase):
+  def __init__(self, batt_id, smapiReader):
+    BattInfoBase.__init__(self, batt_id)
+    self.smapiReader = smapiReader
   def update(self, prefs):
     self.clear()
-    self.installed = self.smapi_get(self.batt_id, 'installed')
+    props = ['installed', 'state', 'remaining_percent',
+      'power_avg', 'power_now', 'remaining_capacity',
+      'last_full_capacity', 'design_capacity']
+    #balance state is only read back when not recently commanded
+    known = dict()
     dischargeStrategy = prefs['dischargeStrategy']
     if dischargeStrategy != DischargeStrategy.SYSTEM:
-      self.force_discharge = self.smapi_get(self.batt_id, 'force_discharge')
-    else:
-      self.force_discharge = 0
+      known['force_discharge'] = self.getCommandedSmapi(
+        prefs, 'force_discharge')
     chargeStrategy = prefs['chargeStrategy']
     if chargeStrategy != ChargeStrategy.SYSTEM:
-      self.inhibit_charge_minutes = self.smapi_get(
-        self.batt_id, 'inhibit_charge_minutes')
-    else:
-      self.inhibit_charge_minutes = 0
-    self.remaining_percent = self.smapi_get(self.batt_id, 'remaining_percent')
-    self.power_avg = self.smapi_get(self.batt_id, 'power_avg')
-    self.power_now = self.smapi_get(self.batt_id, 'power_now')
-    self.remaining_capacity = self.smapi_get(self.batt_id, 'remaining_capacity')
-    self.last_full_capacity = self.smapi_get(self.batt_id, 'last_full_capacity')
-    self.design_capacity = self.smapi_get(self.batt_id, 'design_capacity')
-    state = self.smapi_get(self.batt_id, 'state')
+      known['inhibit_charge_minutes'] = self.getCommandedSmapi(
+        prefs, 'inhibit_charge_minutes')
+    for prop in known:
+      if known[prop] == None:
+        props.append(prop)
+    vals = self.smapiReader.smapi_get_all(self.batt_id, props)
+    for prop in known:
+      if known[prop] != None:
+        vals[prop] = known[prop]
+
+    self.installed = parseInt(vals['installed']) == 1
+    self.force_discharge = parseInt(vals.get('force_discharge', '0')) == 1
+    self.inhibit_charge_minutes = parseInt(
+      vals.get('inhibit_charge_minutes', '0'))
+    self.remaining_percent = parseInt(vals['remaining_percent'])
+    self.power_avg = parseInt(vals['power_avg'])
+    self.power_now = parseInt(vals['power_now'])
+    self.remaining_capacity = parseInt(vals['remaining_capacity'])
+    self.last_full_capacity = parseInt(vals['last_full_capacity'])
+    self.design_capacity = parseInt(vals['design_capacity'])
+    state = vals['state']
     if state == '1':
       self.state = State.CHARGING
     elif state == '2':
@@ -184,53 +513,95 @@ class BattInfoSmapi(BattInfoBase, SmapiReader):
       self.state = State.IDLE
     else:
       self.state = None
+  #the smapi value of prop, as last commanded through balanceInterface
+  def getCommandedSmapi(self, prefs, prop):
+    interface = prefs['balanceInterface']
+    if interface == BalanceInterface.SMAPI:
+      return self.getCommanded(prop)
+    elif interface == BalanceInterface.TPACPI:
+      if prop == 'force_discharge':
+        return self.getCommanded('FD')
+      return self.getCommanded('IC')
+    elif interface == BalanceInterface.THINKPAD_ACPI:
+      behaviour = self.getCommanded('charge_behaviour')
+      if behaviour == None:
+        return None
+      if prop == 'force_discharge':
+        return '1' if behaviour == CHARGE_BEHAVIOUR_FORCE_DISCHARGE else '0'
+      return '1' if behaviour == CHARGE_BEHAVIOUR_INHIBIT_CHARGE else '0'
+    return None
 
 class ACInfoAcpi(ACInfoBase):
+  def __init__(self, root=''):
+    ACInfoBase.__init__(self, root)
+    self.files = SysfsFileCache()
   def acpiAcPath(self):
-    return '/sys/class/power_supply/AC/online'
+    return self.root + ACPI_DIR + '/AC/online'
+  def close(self):
+    self.files.closeAll()
   def update(self, prefs):
-    if os.path.isfile(self.acpiAcPath()):
-      f = open(self.acpiAcPath(), 'r')
-      s = f.read()
-      f.close()
-    else:
-      s = "unknown"
-    if s == "1\n":
-      self.ac_connected = '1'
-    else:
-      self.ac_connected = '0'
+    try:
+      online = self.files.readInt(self.acpiAcPath())
+    except (OSError, ValueError):
+      online = 0
+    self.ac_connected = online == 1
 
 class BattInfoAcpi(BattInfoBase):
-  def acpiDir(self):
-    return "/sys/class/power_supply/BAT" + str(self.batt_id)
+  def __init__(self, batt_id, root=''):
+    BattInfoBase.__init__(self, batt_id)
+    self.dir = root + ACPI_DIR + "/BAT" + str(batt_id)
+    self.files = SysfsFileCache()
+    self.chargeFields = None
+    self.needsDiscovery = True
+    self.lastPresent = None
+  def close(self):
+    self.files.closeAll()
+  def discover(self):
+    self.files.closeAll()
+    self.needsDiscovery = False
+    self.chargeFields = dict()
+    for (quantity, chargeField, energyField) in ACPI_CHARGE_FIELDS:
+      if os.path.isfile(self.dir + "/" + chargeField):
+        self.chargeFields[quantity] = (chargeField, False)
+      elif os.path.isfile(self.dir + "/" + energyField):
+        self.chargeFields[quantity] = (energyField, True)
+      else:
+        self.chargeFields[quantity] = (None, False)
+  def handleReadError(self, e):
+    #the battery went away mid-update; rediscover it next update
+    if e.errno == errno.ENODEV:
+      self.needsDiscovery = True
   def readStr(self, field):
-    filename = self.acpiDir() + "/" + field
-    if os.path.isfile(filename):
-      f = open(filename, 'rb')
-      s = f.read()
-      f.close()
-      return s.strip()
-    else:
-      return ""
+    try:
+      return self.files.read(self.dir + "/" + field).strip()
+    except OSError as e:
+      self.handleReadError(e)
+      return b""
   def readInt(self, field):
     try:
-      return int(self.readStr(field))
+      return self.files.readInt(self.dir + "/" + field)
+    except OSError as e:
+      self.handleReadError(e)
+      return -1
     except ValueError:
       return -1
-  def getChargeValue(self, voltage, chargeField, energyField):
-    charge = self.readInt(chargeField)
-    if charge < 0:
-      energy = self.readInt(energyField)
-      charge = energy / voltage
-    return charge
+  def getEnergyValue(self, voltage, quantity):
+    (field, isEnergy) = self.chargeFields[quantity]
+    if field == None:
+      return -1
+    energy = self.readInt(field)
+    if not isEnergy and energy >= 0:
+      energy = energy * voltage
+    return energy
   def update(self, prefs):
     self.clear()
-    if self.readInt('present') == 1:
-      self.installed = '1'
-    else:
-      self.installed = '0'
+    present = self.readInt('present')
+    if present != self.lastPresent or self.needsDiscovery:
+      self.lastPresent = present
+      self.discover()
 
-    if self.installed != '1':
+    self.installed = present == 1
+    if not self.installed:
       return
 
     status = self.readStr('status').decode('utf-8')
@@ -242,49 +613,65 @@ class BattInfoAcpi(BattInfoBase):
     else:
       self.state = State.IDLE
 
+    self.updateChargeBehaviour(prefs)
+
     microVolts = self.readInt('voltage_now')
-    if microVolts < 0:
+    if self.needsDiscovery:
+      self.clear()
+      return
+    if microVolts <= 0:
       return
     voltage = microVolts / (10**6)
 
-    remMah = 10**-3 * self.getChargeValue(voltage,
-      'charge_now', 'energy_now')
-    lastMah = 10**-3 * self.getChargeValue(voltage,
-      'charge_full', 'energy_full')
-    designMah = 10**-3 * self.getChargeValue(voltage,
-      'charge_full_design', 'energy_full_design')
-    rateAvgMa = 10**-3 * self.getChargeValue(voltage,
-      'current_now', 'power_now')
-
-    if self.state == State.DISCHARGING and rateAvgMa > 0:
-      rateAvgMa *= -1
+    remMwh = 10**-3 * self.getEnergyValue(voltage, 'now')
+    lastMwh = 10**-3 * self.getEnergyValue(voltage, 'full')
+    designMwh = 10**-3 * self.getEnergyValue(voltage, 'full_design')
+    rateMw = 10**-3 * self.getEnergyValue(voltage, 'rate')
+    if self.needsDiscovery:
+      self.clear()
+      return
 
-    self.remaining_capacity = str(remMah)
-    self.last_full_capacity = str(lastMah)
-    self.design_capacity = str(designMah)
-    self.remaining_percent = str(int(100.0 * remMah / lastMah))
-    self.power_avg = str(int(voltage * rateAvgMa)) #mW
-    self.power_now = str(-1) #unsupported in acpi
+    if self.state == State.DISCHARGING and rateMw > 0:
+      rateMw *= -1
+
+    self.remaining_capacity = remMwh
+    self.last_full_capacity = lastMwh
+    self.design_capacity = designMwh
+    if lastMwh > 0:
+      self.remaining_percent = int(100.0 * remMwh / lastMwh)
+    self.power_avg = int(rateMw) #mW
+    self.power_now = -1 #unsupported in acpi
+  def updateChargeBehaviour(self, prefs):
+    if prefs['balanceInterface'] != BalanceInterface.THINKPAD_ACPI:
+      return
+    if not self.isBalanceStateNeeded(prefs):
+      return
+    behaviour = self.getCommanded('charge_behaviour')
+    if behaviour == None:
+      behaviour = parse_charge_behaviour(
+        self.readStr('charge_behaviour').decode('utf-8'))
+    self.force_discharge = behaviour == CHARGE_BEHAVIOUR_FORCE_DISCHARGE
+    if behaviour == CHARGE_BEHAVIOUR_INHIBIT_CHARGE:
+      self.inhibit_charge_minutes = 1
 
 
 
 
 class ACInfoAcpiOld(ACInfoBase):
   def acpiAcPath(self):
-    return '/proc/acpi/ac_adapter/AC/state'
+    return self.root + ACPI_OLD_AC_PATH
   def update(self, prefs):
     if os.path.isfile(self.acpiAcPath()):
-      s = file(self.acpiAcPath()).read()
-      if 'on-line' in s:
-        self.ac_connected = '1'
-      else:
-        self.ac_connected = '0'
+      self.ac_connected = 'on-line' in readFile(self.acpiAcPath())
     else:
-        self.ac_connected = '0'
+      self.ac_connected = False
 
 class BattInfoAcpiOld(BattInfoBase):
+  def __init__(self, batt_id, root=''):
+    self.root = root
+    BattInfoBase.__init__(self, batt_id)
   def acpiDir(self):
-    return "/proc/acpi/battery/BAT" + str(self.batt_id)
+    return self.root + ACPI_OLD_DIR + "/BAT" + str(self.batt_id)
   def acpiStatePath(self):
     return self.acpiDir() + '/state'
   def acpiInfoPath(self):
@@ -303,31 +690,28 @@ class BattInfoAcpiOld(BattInfoBase):
       return None
     else:
       return [int(m.group(1)), m.group(2)]
-  def extractCurrent(self, info, voltMv):
+  def extractEnergy(self, info, voltMv):
     valUnit = self.getValueAndUnit(info)
     if valUnit == None:
       return None
     (val, unit) = valUnit
 
     if unit == 'mAh' or unit == 'mA':
-      return val
+      return val * (voltMv / 1000.0)
     elif unit == 'mWh' or unit == 'mW':
-      return val / (voltMv / 1000.0)
+      return val
     else:
       return None
   def update(self, prefs):
     self.clear()
     statePresent = os.path.isfile(self.acpiStatePath())
     infoPresent = os.path.isfile(self.acpiInfoPath())
-    if statePresent and infoPresent:
-      self.installed = '1'
-    else:
-      self.installed = '0'
+    self.installed = statePresent and infoPresent
 
-    if self.installed == '1':
+    if self.installed:
       atts = dict()
-      atts.update(self.parseAcpi(file(self.acpiStatePath()).read()))
-      atts.update(self.parseAcpi(file(self.acpiInfoPath()).read()))
+      atts.update(self.parseAcpi(readFile(self.acpiStatePath())))
+      atts.update(self.parseAcpi(readFile(self.acpiInfoPath())))
 
       try:
         voltValUnit = self.getValueAndUnit(atts['present voltage'])
@@ -335,16 +719,16 @@ class BattInfoAcpiOld(BattInfoBase):
           return
         voltMv = voltValUnit[0]
 
-        remMah = self.extractCurrent(atts['remaining capacity'], voltMv)
-        lastMah = self.extractCurrent(atts['last full capacity'], voltMv)
-        designMah = self.extractCurrent(atts['design capacity'], voltMv)
-        rateMa = self.extractCurrent(atts['present rate'], voltMv)
+        remMwh = self.extractEnergy(atts['remaining capacity'], voltMv)
+        lastMwh = self.extractEnergy(atts['last full capacity'], voltMv)
+        designMwh = self.extractEnergy(atts['design capacity'], voltMv)
+        rateMw = self.extractEnergy(atts['present rate'], voltMv)
         charge = atts['charging state']
 
         if (False
-          or remMah < 0
-          or lastMah <= 0
-          or rateMa < 0
+          or remMwh < 0
+          or lastMwh <= 0
+          or rateMw < 0
           or voltMv < 0
           ): return
 
@@ -355,15 +739,15 @@ class BattInfoAcpiOld(BattInfoBase):
         else:
           self.state = State.IDLE
 
-        self.remaining_capacity = str(remMah)
-        self.last_full_capacity = str(lastMah)
-        self.design_capacity = str(designMah)
-        self.remaining_percent = str(int(float(remMah) / float(lastMah) * 100.0))
-        power = int(voltMv/1000.0 * rateMa) #mW
+        self.remaining_capacity = remMwh
+        self.last_full_capacity = lastMwh
+        self.design_capacity = designMwh
+        self.remaining_percent = int(float(remMwh) / float(lastMwh) * 100.0)
+        power = int(rateMw) #mW
         if self.state == State.DISCHARGING and power > 0:
-          self.power_avg = str(0 - power)
+          self.power_avg = 0 - power
         else:
-          self.power_avg = str(power)
-        self.power_now = str(-1) #unsupported in acpi
+          self.power_avg = power
+        self.power_now = -1 #unsupported in acpi
       except:
         self.clear()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+import os
+import socket
+import errno
+import json
+
+def getSocketPath():
+  runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+  if runtimeDir != None and os.path.isdir(runtimeDir):
+    return runtimeDir + '/tpbattstat.sock'
+  else:
+    return '/tmp/tpbattstat-' + str(os.getuid()) + '.sock'
+
+def isWouldBlock(e):
+  return e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]
+
+def connectClient(path=None):
+  if path == None:
+    path = getSocketPath()
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except socket.error:
+    sock.close()
+    return None
+  sock.setblocking(False)
+  return SnapshotClient(sock)
+
+class SnapshotServer():
+  def __init__(self, path=None):
+    if path == None:
+      path = getSocketPath()
+    self.path = path
+    if os.path.exists(self.path):
+      client = connectClient(self.path)
+      if client != None:
+        client.close()
+        raise Exception("daemon already running on " + self.path)
+      os.unlink(self.path)
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      self.sock.bind(self.path)
+    except socket.error as e:
+      #another daemon got there between the check above and now
+      self.sock.close()
+      raise Exception("daemon already running on " + self.path + ": " + str(e))
+    os.chmod(self.path, 0o600)
+    self.sock.listen(8)
+    self.sock.setblocking(False)
+    self.clients = []
+    self.lastMsg = None
+  def fileno(self):
+    return self.sock.fileno()
+  def acceptClients(self):
+    while True:
+      try:
+        (client, _) = self.sock.accept()
+      except socket.error as e:
+        if isWouldBlock(e):
+          break
+        raise
+      client.setblocking(False)
+      self.clients.append(client)
+      if self.lastMsg != None:
+        self.send(client, self.lastMsg)
+    return True
+  def publish(self, snapshot):
+    self.lastMsg = (json.dumps(snapshot) + "\n").encode('utf-8')
+    for client in list(self.clients):
+      self.send(client, self.lastMsg)
+  def send(self, client, msg):
+    try:
+      sent = client.send(msg)
+    except socket.error:
+      sent = -1
+    if sent != len(msg):
+      #dead, or too slow to keep up; a partial line would corrupt the stream
+      self.drop(client)
+  def drop(self, client):
+    if client in self.clients:
+      self.clients.remove(client)
+    client.close()
+  def close(self):
+    for client in list(self.clients):
+      self.drop(client)
+    self.sock.close()
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+
+class SnapshotClient():
+  def __init__(self, sock):
+    self.sock = sock
+    self.buf = b''
+    self.closed = False
+  def fileno(self):
+    return self.sock.fileno()
+  def close(self):
+    self.closed = True
+    self.sock.close()
+  def readSnapshot(self):
+    while not self.closed:
+      try:
+        data = self.sock.recv(65536)
+      except socket.error as e:
+        if isWouldBlock(e):
+          break
+        data = b''
+      if len(data) == 0:
+        self.close()
+      else:
+        self.buf += data
+
+    latest = None
+    lines = self.buf.split(b'\n')
+    self.buf = lines[-1]
+    for line in lines[:-1]:
+      if len(line) > 0:
+        latest = line
+    if latest == None:
+      return None
+    return json.loads(latest.decode('utf-8'))
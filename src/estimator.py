@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+from snapshot import (
+  Estimate, MODE_IDLE, MODE_CHARGING, MODE_DISCHARGING)
+import math
+
+class TimeEstimator():
+  def __init__(self):
+    self.mode = MODE_IDLE
+    self.power = None
+    self.lastTime = None
+  def getMode(self, acConnected, batts):
+    if any(batt.isInstalled() and batt.isCharging() for batt in batts):
+      return MODE_CHARGING
+    elif not acConnected and any(batt.isInstalled() for batt in batts):
+      return MODE_DISCHARGING
+    else:
+      return MODE_IDLE
+  def getPower(self, mode, batts):
+    power = 0
+    for batt in batts:
+      if not batt.isInstalled():
+        continue
+      if mode == MODE_CHARGING and batt.power_avg > 0:
+        power += batt.power_avg
+      elif mode == MODE_DISCHARGING and batt.power_avg < 0:
+        power -= batt.power_avg
+    return power
+  def smooth(self, timestamp, mode, power, tau):
+    if mode != self.mode or self.power == None or self.lastTime == None:
+      self.power = float(power)
+    else:
+      dt = max(timestamp - self.lastTime, 0)
+      alpha = 1.0 - math.exp(-dt / max(tau, 1))
+      self.power += alpha * (power - self.power)
+    self.mode = mode
+    self.lastTime = timestamp
+  def getSerialOrder(self, mode, batts):
+    #the balancer drains/fills one battery at a time: active battery first
+    installed = [batt for batt in batts if batt.isInstalled()]
+    if mode == MODE_DISCHARGING:
+      key = lambda batt: (not batt.isDischarging(), -batt.remaining_percent)
+    else:
+      key = lambda batt: (not batt.isCharging(), batt.remaining_percent)
+    return sorted(installed, key=key)
+  def update(self, timestamp, acConnected, batts, tau):
+    mode = self.getMode(acConnected, batts)
+    power = self.getPower(mode, batts)
+    if mode == MODE_IDLE or power <= 0:
+      self.mode = mode
+      self.power = None
+      return Estimate(mode)
+    self.smooth(timestamp, mode, power, tau)
+
+    battTimes = [(None, None)] * len(batts)
+    indexes = dict((batt.batt_id, i) for (i, batt) in enumerate(batts))
+    total = 0.0
+    for batt in self.getSerialOrder(mode, batts):
+      if mode == MODE_DISCHARGING:
+        total += max(batt.remaining_capacity, 0)
+      else:
+        total += max(batt.last_full_capacity - batt.remaining_capacity, 0)
+      seconds = 3600.0 * total / self.power
+      if mode == MODE_DISCHARGING:
+        battTimes[indexes[batt.batt_id]] = (seconds, None)
+      else:
+        battTimes[indexes[batt.batt_id]] = (None, seconds)
+
+    seconds = 3600.0 * total / self.power
+    if mode == MODE_DISCHARGING:
+      return Estimate(mode, self.power, seconds, None, battTimes)
+    else:
+      return Estimate(mode, self.power, None, seconds, battTimes)
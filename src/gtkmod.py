@@ -10,6 +10,15 @@ class GTK_MOD():
   WINDOW_TOPLEVEL = None
   PIXBUF_MOD_NEW_FCT = None
   TIMEOUT_ADD_FCT = None
+  SOURCE_REMOVE_FCT = None
+  IO_ADD_WATCH_FCT = None
+  IO_IN = None
+  IDLE_ADD_FCT = None
+  COLORSPACE_RGB = None
+  PIXBUF_NEW_FROM_DATA_FCT = None
+  PIXBUF_NEW_FROM_BYTES_FCT = None
+  BYTES_NEW_FCT = None
+  PRIORITY_DEFAULT = None
 
   if PYTHON2:
     import gtk
@@ -22,6 +31,13 @@ class GTK_MOD():
     STATE_NORMAL = gtk.STATE_NORMAL
     PIXBUF_MOD_NEW_FCT = gtk.gdk.pixbuf_new_from_file_at_size
     TIMEOUT_ADD_FCT = gobject.timeout_add
+    SOURCE_REMOVE_FCT = gobject.source_remove
+    IO_ADD_WATCH_FCT = gobject.io_add_watch
+    IO_IN = gobject.IO_IN
+    IDLE_ADD_FCT = gobject.idle_add
+    PRIORITY_DEFAULT = gobject.PRIORITY_DEFAULT
+    COLORSPACE_RGB = gtk.gdk.COLORSPACE_RGB
+    PIXBUF_NEW_FROM_DATA_FCT = gtk.gdk.pixbuf_new_from_data
     NEW_COMBO_BOX_FCT = gtk.combo_box_new_text
 
   if PYTHON3:
@@ -36,4 +52,12 @@ class GTK_MOD():
     STATE_NORMAL = Gtk.StateFlags.NORMAL
     PIXBUF_MOD_NEW_FCT = GdkPixbuf.Pixbuf.new_from_file_at_size
     TIMEOUT_ADD_FCT = GLib.timeout_add
+    SOURCE_REMOVE_FCT = GLib.source_remove
+    IO_ADD_WATCH_FCT = GLib.io_add_watch
+    IO_IN = GLib.IOCondition.IN
+    IDLE_ADD_FCT = GLib.idle_add
+    COLORSPACE_RGB = GdkPixbuf.Colorspace.RGB
+    PIXBUF_NEW_FROM_BYTES_FCT = GdkPixbuf.Pixbuf.new_from_bytes
+    BYTES_NEW_FCT = GLib.Bytes.new
+    PRIORITY_DEFAULT = GLib.PRIORITY_DEFAULT
     NEW_COMBO_BOX_FCT = Gtk.ComboBoxText
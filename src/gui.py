@@ -22,20 +22,92 @@
 from battstatus import State
 from guiprefs import GuiPrefs
 from gtkmod import GTK_MOD
+from iconcache import IconDiskCache
+from collections import OrderedDict
 import re
 
 IMAGE_DIR = '/usr/share/pixmaps/tpbattstat-applet/svg'
 
+DECILES = [0,10,20,30,40,50,60,70,80,90,100]
+STATE_DIRS = [
+  (State.IDLE, 'idle'),
+  (State.CHARGING, 'charging'),
+  (State.DISCHARGING, 'discharging')]
+
+#enough for every icon at two sizes, so switching back and forth is free
+PIXBUF_CACHE_SIZE = 2 * (1 + len(STATE_DIRS) * len(DECILES))
+
+def parseSize(size):
+  size = re.match('^(\\d+)x(\\d+)$', size)
+  if size != None:
+    return(int(size.group(1)), int(size.group(2)))
+  else:
+    return (36, 36)
+
+#rasterizes icons on first use, keyed by (size, state, decile)
+# decile=None is the 'none' icon, for a missing battery
+# least recently used icons are dropped once maxSize is reached
+class PixbufCache():
+  def __init__(self, maxSize=PIXBUF_CACHE_SIZE):
+    self.maxSize = maxSize
+    self.pixbufs = OrderedDict()
+    self.prefetchKeys = []
+    self.prefetchId = None
+    self.diskCache = IconDiskCache()
+  def getFilename(self, state, decile):
+    if decile == None:
+      return 'none.svg'
+    for (s, stateDir) in STATE_DIRS:
+      if s == state:
+        return stateDir + '/' + str(decile) + '.svg'
+    return 'idle/' + str(decile) + '.svg'
+  def newPixbuf(self, key):
+    (size, state, decile) = key
+    (w, h) = parseSize(size)
+    return self.diskCache.getPixbuf(
+      IMAGE_DIR + '/' + self.getFilename(state, decile), w, h)
+  def get(self, size, state, decile):
+    key = (size, state, decile)
+    pixbuf = self.pixbufs.pop(key, None)
+    if pixbuf == None:
+      pixbuf = self.newPixbuf(key)
+    self.put(key, pixbuf)
+    return pixbuf
+  def put(self, key, pixbuf):
+    self.pixbufs[key] = pixbuf
+    while len(self.pixbufs) > self.maxSize:
+      self.pixbufs.popitem(last=False)
+  def getKeys(self, size):
+    keys = [(size, None, None)]
+    for (state, stateDir) in STATE_DIRS:
+      for decile in DECILES:
+        keys.append((size, state, decile))
+    return keys
+  def prefetch(self, size):
+    self.prefetchKeys = [k for k in self.getKeys(size) if k not in self.pixbufs]
+    if len(self.prefetchKeys) > 0 and self.prefetchId == None:
+      self.prefetchId = GTK_MOD.IDLE_ADD_FCT(self.onIdle)
+  def onIdle(self):
+    if len(self.prefetchKeys) > 0:
+      key = self.prefetchKeys.pop(0)
+      if key not in self.pixbufs:
+        self.put(key, self.newPixbuf(key))
+    if len(self.prefetchKeys) == 0:
+      self.prefetchId = None
+      return False
+    return True
+
 class Gui():
   def __init__(self, prefs, battStatus, orientation='horizontal'):
     self.prefs = prefs
     self.battStatus = battStatus
     self.label = GTK_MOD.GTK.Label("<?>")
-    self.batt0img = GTK_MOD.GTK.Image()
-    self.batt1img = GTK_MOD.GTK.Image()
+    self.battImgs = [GTK_MOD.GTK.Image(), GTK_MOD.GTK.Image()]
     self.counter = 0
     self.orientation = orientation
     self.pixbufSize = None
+    self.prefetchSize = None
+    self.pixbufs = PixbufCache()
 
     self.container = GTK_MOD.GTK.HBox()
     self.box = None
@@ -53,61 +125,40 @@ class Gui():
     else:
       self.box = GTK_MOD.GTK.HBox()
 
-    self.box.add(self.batt0img)
+    #first battery left of the label, the rest to the right
+    self.box.add(self.battImgs[0])
     self.box.add(self.label)
-    self.box.add(self.batt1img)
+    for img in self.battImgs[1:]:
+      self.box.add(img)
 
     self.container.add(self.box)
     self.container.show_all()
 
-  def parseSize(self, size):
-    size = re.match('^(\\d+)x(\\d+)$', size)
-    if size != None:
-      return(int(size.group(1)), int(size.group(2)))
-    else:
-      return (36, 36)
-  def initPixbufs(self, size):
-    (w, h) = self.parseSize(size)
-    self.none = self.newPixbuf(w, h, 'none.svg')
-    self.idle = []
-    self.charging = []
-    self.discharging = []
-    for i in [0,10,20,30,40,50,60,70,80,90,100]:
-      img = str(i) + '.svg'
-      self.idle.append(self.newPixbuf(w, h, 'idle/' + img))
-      self.charging.append(self.newPixbuf(w, h, 'charging/' + img))
-      self.discharging.append(self.newPixbuf(w, h, 'discharging/' + img))
-
-  def newPixbuf(self, w, h, filename):
-    return GTK_MOD.PIXBUF_MOD_NEW_FCT(
-      IMAGE_DIR + '/' + filename, w, h)
-  def selectPixbufByBattId(self, batt_id):
-    battInfo = self.battStatus.getBattInfo(batt_id)
+  def ensureBattImgs(self, count):
+    count = max(count, 1)
+    if len(self.battImgs) != count:
+      self.battImgs = [GTK_MOD.GTK.Image() for i in range(count)]
+      self.resetLayout()
+  def selectPixbufByBatt(self, battInfo):
     return self.selectPixbuf(battInfo.isInstalled(), battInfo.state,
-      int(float(battInfo.remaining_percent)))
+      battInfo.remaining_percent)
   def selectPixbuf(self, installed, state, percent):
+    size = self.pixbufSize
     if not installed:
-      return self.none
-
-    if state == State.CHARGING:
-      imgs = self.charging
-    elif state == State.DISCHARGING:
-      imgs = self.discharging
-    else:
-      imgs = self.idle
+      return self.pixbufs.get(size, None, None)
 
     i = int(percent / 10)
-    if i < 0 or len(imgs) <= 0:
-      return self.none
-    elif i >= len(imgs):
-      return imgs[len(imgs)-1]
-    else:
-      return imgs[i]
+    if i < 0:
+      return self.pixbufs.get(size, None, None)
+    i = min(i, len(DECILES) - 1)
+    if state == None:
+      #unknown smapi state, shown as idle
+      state = State.IDLE
+    return self.pixbufs.get(size, state, DECILES[i])
   def updateImages(self):
-    size = self.prefs['iconSize']
-    if self.pixbufSize == None or self.pixbufSize != size:
-      self.initPixbufs(size)
-      self.pixbufSize = size
+    self.pixbufSize = self.prefs['iconSize']
+    batts = self.battStatus.snapshot.batts
+    self.ensureBattImgs(len(batts))
 
     if self.prefs['displayIcons']:
       if self.prefs['displayOnlyOneIcon']:
@@ -119,26 +170,29 @@ class Gui():
           state = State.DISCHARGING
         else:
           state = State.IDLE
-        self.batt0img.set_from_pixbuf(
+        self.battImgs[0].set_from_pixbuf(
           self.selectPixbuf(installed, state, percent))
-        self.batt0img.set_child_visible(True)
-        self.batt1img.set_child_visible(False)
+        self.battImgs[0].set_child_visible(True)
+        for img in self.battImgs[1:]:
+          img.set_child_visible(False)
       else:
-        self.batt0img.set_from_pixbuf(self.selectPixbufByBattId(0))
-        self.batt1img.set_from_pixbuf(self.selectPixbufByBattId(1))
-        self.batt0img.set_child_visible(True)
-        self.batt1img.set_child_visible(True)
+        for (img, battInfo) in zip(self.battImgs, batts):
+          img.set_from_pixbuf(self.selectPixbufByBatt(battInfo))
+          img.set_child_visible(True)
     else:
-      self.batt0img.set_child_visible(False)
-      self.batt1img.set_child_visible(False)
+      for img in self.battImgs:
+        img.set_child_visible(False)
+
+    if self.prefs['displayIcons'] and self.prefetchSize != self.pixbufSize:
+      self.prefetchSize = self.pixbufSize
+      self.pixbufs.prefetch(self.pixbufSize)
 
-  def getBattMarkup(self, batt_id):
-    battInfo = self.battStatus.getBattInfo(batt_id)
+  def getBattMarkup(self, battInfo):
     if not battInfo.isInstalled():
       return '<span size="small">X</span>'
-    percent = battInfo.remaining_percent
+    percent = str(battInfo.remaining_percent)
 
-    if percent == '100':
+    if battInfo.remaining_percent == 100:
       size = ' size="xx-small" '
     else:
       size = ' size="small" '
@@ -166,12 +220,14 @@ class Gui():
     return self.orientation == "vertical"
   def getPowerMarkup(self):
     powW = self.battStatus.getPowerDisplay()
+    if self.prefs['displayTimeRemaining']:
+      powW = (powW + ' ' + self.battStatus.getTimeDisplay()).strip()
     return '\n<span size="xx-small">' + powW + '</span>'
   def updateLabel(self):
+    battMarkups = [self.getBattMarkup(battInfo)
+      for battInfo in self.battStatus.snapshot.batts]
     self.label.set_markup(
-      self.getBattMarkup(0) +
-      self.getSeparatorMarkup() +
-      self.getBattMarkup(1) +
+      self.getSeparatorMarkup().join(battMarkups) +
       self.getPowerMarkup())
 
   def update(self):
@@ -20,29 +20,39 @@
 ##########################################################################
 
 from battstatus import State
-import inspect
+import os
 import re
+import sys
+import time
 
 IMAGE_DIR = '/usr/share/pixmaps/tpbattstat-applet/'
 
 CHARGING_COLOR = '#60FF60'
 DISCHARGING_COLOR = '#FF6060'
 
+JSON_MARKUP_RE = re.compile('<[^>]*>')
+DZEN_MARKUP_RE = re.compile('\\^[a-z]+\\(.*?\\)')
+
+def getDefaultClickCmd():
+  return os.path.abspath(sys.argv[0]) + " " + "--prefs"
+
 class MarkupBuilder():
   def fg(self, color, markup): pass
   def appendImage(self, image): pass
   def appendLabel(self, text): pass
   def setClickCmd(self, clickCmd): pass
   def stripMarkup(self, text): pass
+  def escapeImage(self, image): pass
   def imageExtension(self): pass
   def toString(self): pass
 
   def estimateLength(self, text):
     return len(self.stripMarkup(text))
   def pad(self, text, length):
-    curLen = self.estimateLength(text)
-    for i in range(0, length-curLen):
-      text += ' '
+    return self.padLength(text, self.estimateLength(text), length)
+  def padLength(self, text, curLen, length):
+    if curLen < length:
+      text += ' ' * (length - curLen)
     return text
 
 
@@ -52,13 +62,15 @@ class JsonMarkupBuilder(MarkupBuilder):
   def fg(self, color, markup):
     return "<span foreground=\"" + color + "\">" + markup + "</span>"
   def appendImage(self, image):
-    self.append("image", image)
+    self.appendEscaped("image", image)
   def appendLabel(self, text):
     self.append("label", text)
   def setClickCmd(self, clickCmd):
     self.append("click", clickCmd)
   def stripMarkup(self, m):
-    return re.sub('<[^>]*>', '', m)
+    return JSON_MARKUP_RE.sub('', m)
+  def escapeImage(self, image):
+    return self.escapeMarkup(image)
   def imageExtension(self):
     return 'png'
   def toString(self):
@@ -66,7 +78,9 @@ class JsonMarkupBuilder(MarkupBuilder):
 
   def append(self, name, value):
     if value:
-      value = self.escapeMarkup(value)
+      self.appendEscaped(name, self.escapeMarkup(value))
+  def appendEscaped(self, name, value):
+    if value:
       self.items.append("\"" + name + "\": \"" + value + "\"")
   def escapeMarkup(self, m):
     return m.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -85,7 +99,9 @@ class DzenMarkupBuilder(MarkupBuilder):
   def setClickCmd(self, clickCmd):
     self.markup = self.wrapClickMarkup(1, clickCmd, self.markup)
   def stripMarkup(self, m):
-    return re.sub('\\^[a-z]+\\(.*?\\)', '', m)
+    return DZEN_MARKUP_RE.sub('', m)
+  def escapeImage(self, image):
+    return image
   def imageExtension(self):
     return 'xpm'
   def toString(self):
@@ -121,36 +137,100 @@ class DzenMarkupBuilder(MarkupBuilder):
      )
 
 
+#image paths and percent labels, built once per builder type and icon size
+# images are keyed by (state, decile) and already escaped for the builder
+# labels are keyed by (installed, state, percent) => (markup, visibleLength)
+class MarkupTable():
+  def __init__(self, markupBuilder, iconSize, coloredText):
+    self.markupBuilder = markupBuilder
+    self.coloredText = coloredText
+    self.ext = markupBuilder.imageExtension()
+    self.sizeDir = IMAGE_DIR + '/' + self.ext + '/' + iconSize
+    self.noneImage = markupBuilder.escapeImage(
+      self.sizeDir + "/none." + self.ext)
+    self.images = {}
+    self.labels = {}
+    for state in [State.CHARGING, State.DISCHARGING, State.IDLE]:
+      for decile in range(0, 101, 10):
+        self.images[(state, decile)] = self.buildImage(state, decile)
+      for percent in range(0, 101):
+        self.labels[(True, state, percent)] = self.buildLabel(state, percent)
+  def buildImage(self, state, decile):
+    if state == State.CHARGING:
+      stateDir = "charging"
+    elif state == State.DISCHARGING:
+      stateDir = "discharging"
+    else:
+      stateDir = "idle"
+    img = self.sizeDir + "/" + stateDir + "/" + str(decile) + "." + self.ext
+    return self.markupBuilder.escapeImage(img)
+  def buildLabel(self, state, percent):
+    if percent == 100:
+      text = '@@'
+    else:
+      text = str(percent)
+
+    if not self.coloredText or state == State.IDLE:
+      markup = text
+    elif state == State.CHARGING:
+      markup = self.markupBuilder.fg(CHARGING_COLOR, text)
+    elif state == State.DISCHARGING:
+      markup = self.markupBuilder.fg(DISCHARGING_COLOR, text)
+    else:
+      markup = text
+    return (markup, len(text))
+  def getImage(self, installed, state, percent):
+    if not installed:
+      return self.noneImage
+    key = (state, int(percent / 10) * 10)
+    img = self.images.get(key)
+    if img == None:
+      img = self.buildImage(*key)
+      self.images[key] = img
+    return img
+  def getLabel(self, installed, state, percent):
+    if not installed:
+      return ('X', 1)
+    key = (True, state, percent)
+    label = self.labels.get(key)
+    if label == None:
+      label = self.buildLabel(state, percent)
+      self.labels[key] = label
+    return label
+
 class GuiMarkupPrinter():
   def __init__(self, prefs, battStatus, forceIconSize):
     self.prefs = prefs
     self.battStatus = battStatus
     self.counter = 0
     self.forceIconSize = forceIconSize
-  def selectImageByBattId(self, batt_id):
-    battInfo = self.battStatus.getBattInfo(batt_id)
+    self.defaultClickCmd = getDefaultClickCmd()
+    self.lastFragments = None
+    self.lastEmitTime = None
+    self.table = None
+    self.tables = {}
+  def selectImageByBatt(self, battInfo):
     return self.selectImage(battInfo.isInstalled(), battInfo.state,
-      int(float(battInfo.remaining_percent)))
-  def imageDir(self, ext):
+      battInfo.remaining_percent)
+  def getIconSize(self):
     size = self.forceIconSize
     if size == None:
       size = self.prefs['iconSize']
-    return IMAGE_DIR + '/' + ext + '/' + size
+    return size
+  def getTable(self):
+    key = (self.markupBuilder.__class__,
+      self.getIconSize(),
+      self.prefs['displayColoredText'])
+    self.table = self.tables.get(key)
+    if self.table == None:
+      for oldKey in list(self.tables.keys()):
+        if oldKey[1:] != key[1:]:
+          del self.tables[oldKey]
+      self.table = MarkupTable(self.markupBuilder, key[1], key[2])
+      self.tables[key] = self.table
+    return self.table
   def selectImage(self, installed, state, percent):
-    ext = self.markupBuilder.imageExtension()
-    if not installed:
-      return self.imageDir(ext) + "/none." + ext
-
-    img = self.imageDir(ext)
-    if state == State.CHARGING:
-      img = img + "/charging"
-    elif state == State.DISCHARGING:
-      img = img + "/discharging"
-    else:
-      img = img + "/idle"
-
-    img = img + "/" + str(int(percent / 10) * 10) + "." + ext
-    return img
+    return self.table.getImage(installed, state, percent)
   def getJointImage(self):
     if self.prefs['displayIcons'] and self.prefs['displayOnlyOneIcon']:
       installed = self.battStatus.isEitherInstalled()
@@ -164,26 +244,18 @@ class GuiMarkupPrinter():
       return self.selectImage(installed, state, percent)
     else:
       return None
-  def getBattImage(self, batt_id):
+  def getBattImages(self):
+    batts = self.battStatus.snapshot.batts
     if self.prefs['displayIcons'] and not self.prefs['displayOnlyOneIcon']:
-      return self.selectImageByBattId(batt_id)
+      return tuple(self.selectImageByBatt(battInfo) for battInfo in batts)
     else:
-      return None
-  def getBattPercentMarkup(self, batt_id):
-    battInfo = self.battStatus.getBattInfo(batt_id)
-    if not battInfo.isInstalled():
-      return 'X'
-    percent = battInfo.remaining_percent
-
-    if percent == '100':
-      percent = '@@'
-
-    if not self.prefs['displayColoredText'] or battInfo.state == State.IDLE:
-      return percent
-    elif battInfo.state == State.CHARGING:
-      return self.markupBuilder.fg(CHARGING_COLOR, percent)
-    elif battInfo.state == State.DISCHARGING:
-      return self.markupBuilder.fg(DISCHARGING_COLOR, percent)
+      return tuple(None for battInfo in batts)
+  def getBattPercentMarkups(self):
+    batts = self.battStatus.snapshot.batts
+    return tuple(self.getBattPercentMarkup(battInfo) for battInfo in batts)
+  def getBattPercentMarkup(self, battInfo):
+    return self.table.getLabel(battInfo.isInstalled(), battInfo.state,
+      battInfo.remaining_percent)
   def getSeparatorMarkup(self):
     sep = "|"
     if self.prefs['displayBlinkingIndicator'] and self.counter % 2 == 0:
@@ -191,32 +263,64 @@ class GuiMarkupPrinter():
     else:
       return sep
   def getPowerMarkup(self):
-    return self.battStatus.getPowerDisplay()
+    powW = self.battStatus.getPowerDisplay()
+    if self.prefs['displayTimeRemaining']:
+      powW = (powW + ' ' + self.battStatus.getTimeDisplay()).strip()
+    return powW
   def getLeftClickCmd(self):
-    exe=inspect.stack()[-1][1]
-    return exe + " " + "--prefs"
-  def getBattLabelMarkup(self):
-    return (''
-          + self.getBattPercentMarkup(0)
-          + self.getSeparatorMarkup()
-          + self.getBattPercentMarkup(1)
-          )
+    clickCmd = self.prefs['clickCommand']
+    if clickCmd == '':
+      clickCmd = self.defaultClickCmd
+    return clickCmd
+  def getBattLabelMarkup(self, percents):
+    return self.getSeparatorMarkup().join(
+      markup for (markup, length) in percents)
+  def getBattLabelLength(self, percents):
+    return sum(length for (markup, length) in percents) + len(percents) - 1
   def getMarkupJson(self):
     self.markupBuilder = JsonMarkupBuilder()
     return self.getGuiMarkup()
   def getMarkupDzen(self):
     self.markupBuilder = DzenMarkupBuilder()
     return self.getGuiMarkup()
+  def getFragments(self):
+    self.getTable()
+    return (self.markupBuilder.imageExtension(),
+      self.getJointImage(),
+      self.getBattImages(),
+      self.getBattPercentMarkups(),
+      self.getPowerMarkup(),
+      self.getLeftClickCmd())
+  def isHeartbeatDue(self, now):
+    heartbeat = self.prefs['markupHeartbeat']
+    if heartbeat <= 0 or self.lastEmitTime == None:
+      return False
+    return (now - self.lastEmitTime) * 1000 >= heartbeat
   def getGuiMarkup(self):
+    fragments = self.getFragments()
+    now = time.time()
+    if (self.prefs['markupOnlyOnChange']
+        and fragments == self.lastFragments
+        and not self.isHeartbeatDue(now)):
+      return None
+    self.lastFragments = fragments
+    self.lastEmitTime = now
+    (ext, jointImage, battImages, percents, power, clickCmd) = fragments
+
     self.counter = self.counter + 1
 
-    self.markupBuilder.appendImage(self.getJointImage())
-    self.markupBuilder.appendImage(self.getBattImage(0))
+    self.markupBuilder.appendImage(jointImage)
+    #first battery left of the label, the rest to the right
+    for battImage in battImages[:1]:
+      self.markupBuilder.appendImage(battImage)
     self.markupBuilder.appendLabel(''
-          + self.markupBuilder.pad(self.getBattLabelMarkup(), 6)
+          + self.markupBuilder.padLength(
+              self.getBattLabelMarkup(percents),
+              self.getBattLabelLength(percents), 6)
           + "\n"
-          + self.markupBuilder.pad(self.getPowerMarkup(), 6)
+          + self.markupBuilder.padLength(power, len(power), 6)
           )
-    self.markupBuilder.appendImage(self.getBattImage(1))
-    self.markupBuilder.setClickCmd(self.getLeftClickCmd())
+    for battImage in battImages[1:]:
+      self.markupBuilder.appendImage(battImage)
+    self.markupBuilder.setClickCmd(clickCmd)
     return self.markupBuilder.toString()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+from prefs import State, getCacheDir
+import fcntl
+import mmap
+import os
+import struct
+
+HISTORY_MAGIC = b'TPBH'
+HISTORY_VERSION = 3
+#battery slots in every record, so docking/undocking keeps the file as is
+HISTORY_BATT_SLOTS = 4
+NO_BATT_ID = 255
+
+#magic, version, battery slots, capacity, head, count
+HEADER = struct.Struct('<4sHHIII')
+#timestamp, ac_connected
+RECORD_HEAD = struct.Struct('<dB')
+#batt_id (NO_BATT_ID for an empty slot), state, remaining_percent,
+#  remaining_capacity, last_full_capacity, design_capacity, power_avg, power_now
+RECORD_BATT = struct.Struct('<BBBfffii')
+
+STATE_NOT_INSTALLED = 0
+STATE_CODES = {None: 1, State.IDLE: 1, State.CHARGING: 2, State.DISCHARGING: 3}
+STATE_NAMES = {1: State.IDLE, 2: State.CHARGING, 3: State.DISCHARGING}
+
+def getHistoryPath():
+  return getCacheDir() + '/history.bin'
+
+class BattHistory():
+  def __init__(self, path, capacity):
+    self.path = path
+    self.capacity = capacity
+    self.battCount = HISTORY_BATT_SLOTS
+    self.recordSize = RECORD_HEAD.size + self.battCount * RECORD_BATT.size
+    size = HEADER.size + capacity * self.recordSize
+
+    histDir = os.path.dirname(path)
+    if not os.path.isdir(histDir):
+      os.makedirs(histDir, 0o755)
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+      os.close(self.fd)
+      raise Exception("history is in use by another process: " + path)
+
+    if os.fstat(self.fd).st_size != size:
+      os.ftruncate(self.fd, 0)
+      os.ftruncate(self.fd, size)
+    self.mm = mmap.mmap(self.fd, size)
+
+    (magic, version, count, cap, head, length) = HEADER.unpack_from(self.mm, 0)
+    if (magic != HISTORY_MAGIC or version != HISTORY_VERSION
+        or count != self.battCount or cap != capacity
+        or head >= capacity or length > capacity):
+      (head, length) = (0, 0)
+    self.head = head
+    self.length = length
+    self.writeHeader()
+  def writeHeader(self):
+    HEADER.pack_into(self.mm, 0, HISTORY_MAGIC, HISTORY_VERSION,
+      self.battCount, self.capacity, self.head, self.length)
+  def append(self, timestamp, snapshot):
+    offset = HEADER.size + self.head * self.recordSize
+    RECORD_HEAD.pack_into(self.mm, offset, timestamp,
+      1 if snapshot.ac_connected else 0)
+    offset += RECORD_HEAD.size
+    #batteries past the last slot (or with huge ids) are not kept
+    batts = [batt for batt in snapshot.batts if batt.batt_id < NO_BATT_ID]
+    batts = batts[:self.battCount]
+    for batt in batts:
+      if batt.installed:
+        state = STATE_CODES[batt.state]
+      else:
+        state = STATE_NOT_INSTALLED
+      RECORD_BATT.pack_into(self.mm, offset, batt.batt_id, state,
+        min(max(batt.remaining_percent, 0), 255), batt.remaining_capacity,
+        batt.last_full_capacity, batt.design_capacity,
+        batt.power_avg, batt.power_now)
+      offset += RECORD_BATT.size
+    for i in range(len(batts), self.battCount):
+      RECORD_BATT.pack_into(self.mm, offset, NO_BATT_ID, STATE_NOT_INSTALLED,
+        0, 0, 0, 0, 0, 0)
+      offset += RECORD_BATT.size
+
+    self.head = (self.head + 1) % self.capacity
+    if self.length < self.capacity:
+      self.length += 1
+    self.writeHeader()
+  def __len__(self):
+    return self.length
+  def get(self, index):
+    #index 0 is the oldest sample, -1 the newest
+    if index < 0:
+      index += self.length
+    if index < 0 or index >= self.length:
+      raise IndexError("history index out of range")
+    slot = (self.head - self.length + index) % self.capacity
+    offset = HEADER.size + slot * self.recordSize
+    (timestamp, ac) = RECORD_HEAD.unpack_from(self.mm, offset)
+    offset += RECORD_HEAD.size
+    batts = []
+    for i in range(self.battCount):
+      (batt_id, state, percent, cap, lastFull, design, powerAvg, powerNow) = (
+        RECORD_BATT.unpack_from(self.mm, offset))
+      offset += RECORD_BATT.size
+      if batt_id != NO_BATT_ID:
+        batts.append((batt_id, state != STATE_NOT_INSTALLED,
+          STATE_NAMES.get(state), percent, cap, lastFull, design,
+          powerAvg, powerNow))
+    return (timestamp, ac == 1, batts)
+  def flush(self):
+    self.mm.flush()
+  def close(self):
+    self.mm.flush()
+    self.mm.close()
+    os.close(self.fd)
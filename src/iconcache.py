@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+from gtkmod import GTK_MOD
+from prefs import getCacheDir
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+ICON_MAGIC = b'TPBI'
+ICON_VERSION = 1
+
+#magic, version, width, height, rowstride, has alpha, pixel data length
+ICON_HEADER = struct.Struct('<4sHIIIBI')
+
+def getIconCacheDir():
+  return getCacheDir() + '/icons'
+
+def hashFile(path):
+  with open(path, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+def getPixbufData(pixbuf):
+  if GTK_MOD.PYTHON3:
+    return pixbuf.read_pixel_bytes().get_data()
+  else:
+    return pixbuf.get_pixels()
+
+def newPixbufFromData(data, hasAlpha, w, h, rowstride):
+  if GTK_MOD.PYTHON3:
+    return GTK_MOD.PIXBUF_NEW_FROM_BYTES_FCT(GTK_MOD.BYTES_NEW_FCT(data),
+      GTK_MOD.COLORSPACE_RGB, hasAlpha, 8, w, h, rowstride)
+  else:
+    return GTK_MOD.PIXBUF_NEW_FROM_DATA_FCT(data,
+      GTK_MOD.COLORSPACE_RGB, hasAlpha, 8, w, h, rowstride)
+
+#raw RGB(A) pixels of rendered SVGs, so startup does not need librsvg
+# entries are named <svg>-<WxH>-<sha1 of svg>.rgba
+# a changed svg gets a new name, and the old entry is removed when written
+class IconDiskCache():
+  def __init__(self, cacheDir=None):
+    if cacheDir == None:
+      cacheDir = getIconCacheDir()
+    self.cacheDir = cacheDir
+    self.writable = True
+  def getEntryPrefix(self, svgFile, w, h):
+    name = svgFile.strip('/').replace('/', '_')
+    return name + '-' + str(w) + 'x' + str(h) + '-'
+  def getEntryPath(self, svgFile, w, h, digest):
+    return (self.cacheDir + '/'
+      + self.getEntryPrefix(svgFile, w, h) + digest + '.rgba')
+  def getPixbuf(self, svgFile, w, h):
+    try:
+      digest = hashFile(svgFile)
+    except (IOError, OSError):
+      return GTK_MOD.PIXBUF_MOD_NEW_FCT(svgFile, w, h)
+    entryPath = self.getEntryPath(svgFile, w, h, digest)
+
+    pixbuf = self.load(entryPath)
+    if pixbuf == None:
+      pixbuf = GTK_MOD.PIXBUF_MOD_NEW_FCT(svgFile, w, h)
+      self.store(svgFile, w, h, entryPath, pixbuf)
+    return pixbuf
+  def load(self, entryPath):
+    try:
+      fd = os.open(entryPath, os.O_RDONLY)
+    except OSError:
+      return None
+    try:
+      size = os.fstat(fd).st_size
+      if size < ICON_HEADER.size:
+        return None
+      mm = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+      try:
+        (magic, version, width, height, rowstride, hasAlpha, dataLen
+          ) = ICON_HEADER.unpack_from(mm, 0)
+        if (magic != ICON_MAGIC or version != ICON_VERSION
+            or ICON_HEADER.size + dataLen != size):
+          return None
+        data = mm[ICON_HEADER.size:]
+      finally:
+        mm.close()
+    finally:
+      os.close(fd)
+    return newPixbufFromData(data, hasAlpha == 1, width, height, rowstride)
+  def store(self, svgFile, w, h, entryPath, pixbuf):
+    if not self.writable:
+      return
+    try:
+      if not os.path.isdir(self.cacheDir):
+        os.makedirs(self.cacheDir, 0o755)
+      self.removeStale(svgFile, w, h, entryPath)
+
+      data = getPixbufData(pixbuf)
+      header = ICON_HEADER.pack(ICON_MAGIC, ICON_VERSION,
+        pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_rowstride(),
+        1 if pixbuf.get_has_alpha() else 0, len(data))
+      tmpPath = entryPath + '.' + str(os.getpid()) + '.tmp'
+      with open(tmpPath, 'wb') as f:
+        f.write(header)
+        f.write(data)
+      os.rename(tmpPath, entryPath)
+    except (IOError, OSError) as e:
+      sys.stderr.write("not caching icons: " + str(e) + "\n")
+      self.writable = False
+  def removeStale(self, svgFile, w, h, entryPath):
+    prefix = self.getEntryPrefix(svgFile, w, h)
+    entryName = os.path.basename(entryPath)
+    for name in os.listdir(self.cacheDir):
+      if name.startswith(prefix) and name != entryName:
+        os.remove(self.cacheDir + '/' + name)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+import heapq
+import select
+try:
+  from time import monotonic
+except ImportError:
+  from time import time as monotonic
+
+#gtkmod imports gtk, so only GtkLoop pulls it in, and only when created
+class GtkLoop():
+  def __init__(self):
+    from gtkmod import GTK_MOD
+    self.gtkMod = GTK_MOD
+  def timeoutAdd(self, delay, fct):
+    return self.gtkMod.TIMEOUT_ADD_FCT(delay, fct)
+  def sourceRemove(self, sourceId):
+    self.gtkMod.SOURCE_REMOVE_FCT(sourceId)
+  def ioAddWatch(self, fd, fct):
+    callback = lambda source, condition: fct()
+    if self.gtkMod.PYTHON2:
+      return self.gtkMod.IO_ADD_WATCH_FCT(fd, self.gtkMod.IO_IN, callback)
+    else:
+      return self.gtkMod.IO_ADD_WATCH_FCT(fd, self.gtkMod.PRIORITY_DEFAULT,
+        self.gtkMod.IO_IN, callback)
+  def run(self):
+    self.gtkMod.GTK.main()
+  def quit(self):
+    self.gtkMod.GTK.main_quit()
+
+#same interface as GtkLoop, on plain select(), for json/dzen/daemon
+# like glib, callbacks that return True are kept, anything else removes them
+class SelectLoop():
+  def __init__(self):
+    self.nextId = 1
+    self.timeouts = {}
+    self.timeoutHeap = []
+    self.watches = {}
+    self.running = False
+  def newId(self):
+    sourceId = self.nextId
+    self.nextId = self.nextId + 1
+    return sourceId
+  def timeoutAdd(self, delay, fct):
+    sourceId = self.newId()
+    self.timeouts[sourceId] = (delay, fct)
+    self.pushTimeout(sourceId, delay)
+    return sourceId
+  def pushTimeout(self, sourceId, delay):
+    heapq.heappush(self.timeoutHeap, (monotonic() + delay / 1000.0, sourceId))
+  def sourceRemove(self, sourceId):
+    self.timeouts.pop(sourceId, None)
+    self.watches.pop(sourceId, None)
+  def ioAddWatch(self, fd, fct):
+    sourceId = self.newId()
+    self.watches[sourceId] = (fd, fct)
+    return sourceId
+  def getWaitTime(self):
+    #removed timeouts stay in the heap until they reach the top
+    while len(self.timeoutHeap) > 0 and self.timeoutHeap[0][1] not in self.timeouts:
+      heapq.heappop(self.timeoutHeap)
+    if len(self.timeoutHeap) == 0:
+      return None
+    return max(0, self.timeoutHeap[0][0] - monotonic())
+  def runWatches(self, waitTime):
+    fds = {}
+    for (sourceId, (fd, fct)) in list(self.watches.items()):
+      fds.setdefault(fd, []).append(sourceId)
+    (ready, _, _) = select.select(list(fds.keys()), [], [], waitTime)
+    for fd in ready:
+      for sourceId in fds[fd]:
+        watch = self.watches.get(sourceId)
+        if watch != None and watch[1]() != True:
+          self.sourceRemove(sourceId)
+  def runTimeouts(self):
+    now = monotonic()
+    while len(self.timeoutHeap) > 0 and self.timeoutHeap[0][0] <= now:
+      (_, sourceId) = heapq.heappop(self.timeoutHeap)
+      timeout = self.timeouts.get(sourceId)
+      if timeout == None:
+        continue
+      (delay, fct) = timeout
+      if fct() == True and sourceId in self.timeouts:
+        self.pushTimeout(sourceId, delay)
+      else:
+        self.sourceRemove(sourceId)
+  def run(self):
+    self.running = True
+    while self.running:
+      waitTime = self.getWaitTime()
+      if waitTime == None and len(self.watches) == 0:
+        break
+      self.runWatches(waitTime)
+      self.runTimeouts()
+  def quit(self):
+    self.running = False
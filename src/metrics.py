@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+#serves the latest readings as OpenMetrics text over http,
+#  on a unix socket or a tcp port (localhost unless a host is given)
+#  e.g.: curl --unix-socket $XDG_RUNTIME_DIR/tpbattstat-metrics.sock http://localhost/metrics
+#        curl http://localhost:9638/metrics
+
+from prefs import State
+from daemon import isWouldBlock
+import os
+import socket
+
+DEFAULT_METRICS_PORT = 9638
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+MAX_REQUEST_SIZE = 8192
+#ms a client gets to send its request before it is dropped
+CLIENT_TIMEOUT = 5000
+#seconds a response may take to send, blocking the loop
+SEND_TIMEOUT = 1.0
+METRICS_PATHS = ['/', '/metrics']
+STATE_NAMES = [
+  (State.IDLE, 'idle'),
+  (State.CHARGING, 'charging'),
+  (State.DISCHARGING, 'discharging')]
+
+def getMetricsSocketPath():
+  runtimeDir = os.environ.get('XDG_RUNTIME_DIR')
+  if runtimeDir != None and os.path.isdir(runtimeDir):
+    return runtimeDir + '/tpbattstat-metrics.sock'
+  else:
+    return '/tmp/tpbattstat-metrics-' + str(os.getuid()) + '.sock'
+
+def formatValue(val):
+  if isinstance(val, bool):
+    return str(int(val))
+  elif isinstance(val, float):
+    return repr(val)
+  else:
+    return str(val)
+
+#one metric family: TYPE/HELP/UNIT lines, then its samples
+class MetricFamily():
+  def __init__(self, name, metricType, helpText, unit=None):
+    self.name = name
+    self.lines = ['# TYPE ' + name + ' ' + metricType]
+    if unit != None:
+      self.lines.append('# UNIT ' + name + ' ' + unit)
+    self.lines.append('# HELP ' + name + ' ' + helpText)
+  def add(self, val, labels=None, suffix=''):
+    line = self.name + suffix
+    if labels != None and len(labels) > 0:
+      line += '{' + ','.join(
+        k + '="' + v + '"' for (k, v) in labels) + '}'
+    self.lines.append(line + ' ' + formatValue(val))
+
+#what one update produced; the text is only built on the first scrape
+class MetricsSample():
+  def __init__(self, snapshot, balanceCounts=None, updateSeconds=None,
+               updates=None):
+    self.snapshot = snapshot
+    #[(governor name, (switches, suppressed)), ...]
+    self.balanceCounts = balanceCounts
+    self.updateSeconds = updateSeconds
+    self.updates = updates
+    self.body = None
+  def getBody(self):
+    if self.body == None:
+      self.body = self.render().encode('utf-8')
+    return self.body
+  def render(self):
+    snapshot = self.snapshot
+    families = []
+
+    ac = MetricFamily('tpbattstat_ac_online', 'gauge',
+      '1 when AC is connected')
+    ac.add(snapshot.isACConnected())
+    families.append(ac)
+
+    battFamilies = [
+      ('installed', 'gauge', '1 when the battery is present', None,
+        lambda b: b.isInstalled()),
+      ('percent', 'gauge', 'Remaining charge in percent', None,
+        lambda b: b.remaining_percent),
+      ('energy_watthours', 'gauge', 'Remaining energy', 'watthours',
+        lambda b: b.remaining_capacity / 1000.0),
+      ('energy_full_watthours', 'gauge', 'Energy when last fully charged',
+        'watthours', lambda b: b.last_full_capacity / 1000.0),
+      ('energy_full_design_watthours', 'gauge', 'Design energy',
+        'watthours', lambda b: b.design_capacity / 1000.0),
+      ('power_watts', 'gauge', 'Average power, negative when discharging',
+        'watts', lambda b: b.power_avg / 1000.0),
+      ('force_discharge', 'gauge', '1 when forced to discharge on AC', None,
+        lambda b: b.isForceDischarge()),
+      ('inhibit_charge', 'gauge', '1 when charging is inhibited', None,
+        lambda b: b.isChargeInhibited()),
+    ]
+    for (suffix, metricType, helpText, unit, fct) in battFamilies:
+      family = MetricFamily('tpbattstat_battery_' + suffix, metricType,
+        helpText, unit)
+      for batt in snapshot.batts:
+        family.add(fct(batt), [('battery', 'BAT' + str(batt.batt_id))])
+      families.append(family)
+
+    state = MetricFamily('tpbattstat_battery_state', 'stateset',
+      'Charging state of the battery')
+    for batt in snapshot.batts:
+      for (s, stateName) in STATE_NAMES:
+        state.add(batt.isInstalled() and batt.state == s,
+          [('battery', 'BAT' + str(batt.batt_id)),
+           ('tpbattstat_battery_state', stateName)])
+    families.append(state)
+
+    if self.balanceCounts != None:
+      switches = MetricFamily('tpbattstat_balance_switches', 'counter',
+        'Times the balancer switched which battery charges/discharges')
+      suppressed = MetricFamily('tpbattstat_balance_suppressed', 'counter',
+        'Switches held off by hysteresis, dwell time or rate limit')
+      for (governor, (switchCount, suppressedCount)) in self.balanceCounts:
+        switches.add(switchCount, [('governor', governor)], '_total')
+        suppressed.add(suppressedCount, [('governor', governor)], '_total')
+      families.append(switches)
+      families.append(suppressed)
+
+    if self.updateSeconds != None:
+      duration = MetricFamily('tpbattstat_update_duration_seconds', 'gauge',
+        'How long the last update took to read, balance and act', 'seconds')
+      duration.add(self.updateSeconds)
+      families.append(duration)
+    if self.updates != None:
+      updates = MetricFamily('tpbattstat_updates', 'counter',
+        'Updates since startup')
+      updates.add(self.updates, suffix='_total')
+      families.append(updates)
+
+    lines = []
+    for family in families:
+      lines.extend(family.lines)
+    lines.append('# EOF')
+    return "\n".join(lines) + "\n"
+
+#addr: a path for a unix socket, or [HOST:]PORT for tcp
+class MetricsServer():
+  def __init__(self, loop, addr=None):
+    self.loop = loop
+    self.sample = None
+    self.clients = dict()
+    self.path = None
+    if addr == None:
+      addr = getMetricsSocketPath()
+    if '/' in addr:
+      self.path = addr
+      self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      if os.path.exists(self.path):
+        try:
+          self.sock.connect(self.path)
+        except socket.error:
+          os.unlink(self.path)
+        else:
+          self.sock.close()
+          raise Exception("exporter already running on " + self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.sock.bind(self.path)
+      os.chmod(self.path, 0o600)
+    else:
+      (host, _, port) = addr.rpartition(':')
+      if host == '':
+        host = '127.0.0.1'
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      self.sock.bind((host, int(port)))
+    self.sock.listen(8)
+    self.sock.setblocking(False)
+  def fileno(self):
+    return self.sock.fileno()
+  def publish(self, sample):
+    self.sample = sample
+  def acceptClients(self):
+    while True:
+      try:
+        (client, _) = self.sock.accept()
+      except socket.error as e:
+        if isWouldBlock(e):
+          break
+        raise
+      client.setblocking(False)
+      #request so far, io watch, timeout
+      self.clients[client] = [b'',
+        self.loop.ioAddWatch(client.fileno(),
+          lambda client=client: self.readRequest(client)),
+        self.loop.timeoutAdd(CLIENT_TIMEOUT,
+          lambda client=client: self.onClientTimeout(client))]
+    return True
+  def onClientTimeout(self, client):
+    if client in self.clients:
+      self.loop.sourceRemove(self.clients[client][1])
+      self.clients[client][2] = None
+      self.drop(client)
+    return False
+  def readRequest(self, client):
+    try:
+      data = client.recv(MAX_REQUEST_SIZE)
+    except socket.error as e:
+      if isWouldBlock(e):
+        return True
+      data = b''
+    if len(data) == 0:
+      self.drop(client)
+      return False
+    buf = self.clients[client][0] + data
+    self.clients[client][0] = buf
+    if b'\r\n\r\n' not in buf and b'\n\n' not in buf:
+      if len(buf) > MAX_REQUEST_SIZE:
+        self.respond(client, '431 Request Header Fields Too Large')
+        return False
+      return True
+    requestLine = buf.split(b'\n', 1)[0].decode('utf-8', 'replace').split()
+    if len(requestLine) < 2:
+      self.respond(client, '400 Bad Request')
+    elif requestLine[0] not in ['GET', 'HEAD']:
+      self.respond(client, '405 Method Not Allowed')
+    elif requestLine[1].split('?', 1)[0] not in METRICS_PATHS:
+      self.respond(client, '404 Not Found')
+    elif self.sample == None:
+      self.respond(client, '503 Service Unavailable')
+    else:
+      self.respond(client, '200 OK', self.sample.getBody(),
+        requestLine[0] == 'HEAD')
+    return False
+  def respond(self, client, status, body=None, headOnly=False):
+    contentType = CONTENT_TYPE
+    if body == None:
+      body = (status + "\n").encode('utf-8')
+      contentType = 'text/plain; charset=utf-8'
+    msg = ("HTTP/1.1 " + status + "\r\n"
+      + "Content-Type: " + contentType + "\r\n"
+      + "Content-Length: " + str(len(body)) + "\r\n"
+      + "Connection: close\r\n"
+      + "\r\n").encode('utf-8')
+    if not headOnly:
+      msg += body
+    try:
+      client.settimeout(SEND_TIMEOUT)
+      client.sendall(msg)
+    except socket.error:
+      pass
+    self.drop(client)
+  def drop(self, client):
+    #the io watch goes away when its callback returns False
+    state = self.clients.pop(client, None)
+    if state != None and state[2] != None:
+      self.loop.sourceRemove(state[2])
+    client.close()
+  def close(self):
+    for client in list(self.clients.keys()):
+      self.loop.sourceRemove(self.clients[client][1])
+      self.drop(client)
+    self.sock.close()
+    if self.path != None and os.path.exists(self.path):
+      os.unlink(self.path)
@@ -33,7 +33,7 @@ def enum(*sequential, **named):
 State = enum('CHARGING', 'DISCHARGING', 'IDLE')
 DischargeStrategy = enum('SYSTEM', 'LEAPFROG', 'CHASING')
 ChargeStrategy = enum('SYSTEM', 'LEAPFROG', 'CHASING', 'BRACKETS')
-Interface = enum('ACPI', 'SMAPI', 'ACPI_OLD')
+Interface = enum('ACPI', 'SMAPI', 'ACPI_OLD', 'REPLAY')
 BalanceInterface = enum('THINKPAD_ACPI', 'SMAPI', 'TPACPI')
 PowerUsage = enum('NOW', 'AVERAGE', 'OFF')
 
@@ -41,9 +41,25 @@ def getPrefs():
   return [
   Pref("delay", "int", 1000,
     "Delay in ms between updates"),
+  Pref("adaptiveDelay", "bool", False,
+    "Vary the delay between adaptiveDelayMin and adaptiveDelayMax"),
+  Pref("adaptiveDelayMin", "int", 1000,
+    "Delay in ms when values change or balancing is near a threshold"),
+  Pref("adaptiveDelayMax", "int", 16000,
+    "Delay in ms when nothing has changed for a while"),
+  Pref("useUevents", "bool", False,
+    "Update immediately on power_supply uevents (AC plug/unplug, etc)"),
+  Pref("ueventDelay", "int", 30000,
+    "Delay in ms between updates when useUevents is on"),
   Pref("interface", "enum", "SMAPI",
-    "Battery info interface (smapi/acpi)",
+    "Battery info interface (smapi/acpi/acpi_old/replay)",
     Interface),
+  Pref("sysfsRoot", "string", "",
+    "Directory to read /sys and /proc from instead of /, e.g.: a copied tree"),
+  Pref("replayFile", "string", "",
+    "power_supply recording to play back with interface=replay"),
+  Pref("replaySpeed", "int", 60,
+    "How many times faster than real time to play back replayFile"),
   Pref("balanceInterface", "enum", "THINKPAD_ACPI",
     "Interface for balancing batteries",
     BalanceInterface),
@@ -61,11 +77,34 @@ def getPrefs():
   Pref("chargeBrackets", "list-int", [10, 20, 80, 90, 95, 100],
     "Brackets to ensure even charge in charge_strategy=brackets."),
   Pref("chargeBracketsPrefBattery", "int", 0,
-    "Battery to charge when both batteries are in the same bracket"),
+    "Battery to charge first when several batteries are in the same bracket"),
+
+  Pref("balanceHysteresis", "int", 2,
+    "Only switch batteries after a percent has moved this much since the last switch"),
+  Pref("balanceMinDwell", "int", 60000,
+    "Minimum ms between switching which battery charges/discharges"),
+  Pref("balanceMaxSwitchesPerHour", "int", 12,
+    "Maximum battery switches per hour; 0 for no limit"),
+  Pref("balanceVerifyInterval", "int", 60000,
+    "Re-read and re-send unchanged balance commands after N ms; 0 for every update"),
+  Pref("historySize", "int", 0,
+    "Number of samples kept in ~/.cache/tpbattstat/history.bin; 0 to disable"),
+  Pref("historyFlushInterval", "int", 60000,
+    "Delay in ms between writing the history to disk"),
+  Pref("stats", "bool", False,
+    "Record how long each stage of an update takes, and subprocess/sysfs read counts"),
+  Pref("statsInterval", "int", 60000,
+    "Delay in ms between writing stats to ~/.cache/tpbattstat/stats-MODE.json"),
+  Pref("statsStderr", "bool", False,
+    "Also print a one-line stats summary to stderr every statsInterval"),
 
   Pref("displayPowerUsage", "enum", "NOW",
     "Display power rate in watts, instantaneous or average over the last 60s",
     PowerUsage),
+  Pref("displayTimeRemaining", "bool", False,
+    "Show time until empty/full next to the power usage"),
+  Pref("estimateSmoothing", "int", 120,
+    "Time constant in seconds for smoothing power usage in time estimates"),
   Pref("displayColoredText", "bool", True,
     "Green/red for charging/discharging"),
   Pref("iconSize", "string", "36x36",
@@ -76,6 +115,12 @@ def getPrefs():
     "Show one icon with the sum of remaining charge of both batteries"),
   Pref("displayBlinkingIndicator", "bool", True,
     "Alternate separator color every time the display updates"),
+  Pref("markupOnlyOnChange", "bool", False,
+    "In json/dzen, only print a line when something other than the separator changes"),
+  Pref("markupHeartbeat", "int", 0,
+    "With markupOnlyOnChange, reprint at least every N ms anyway; 0 for never"),
+  Pref("clickCommand", "string", "",
+    "Command to run on left click in json/dzen; empty for the prefs dialog"),
   Pref("ledPatternsCharging", "list-string", [],
     "Patterns for the battery LED when charging"),
   Pref("ledPatternsDischarging", "list-string", [],
@@ -93,6 +138,12 @@ class Pref():
     self.enum = enum
     self.longDesc = None
 
+def getCacheDir():
+  cacheDir = os.environ.get('XDG_CACHE_HOME')
+  if cacheDir == None or cacheDir == '':
+    cacheDir = os.environ['HOME'] + '/.cache'
+  return cacheDir + '/tpbattstat'
+
 class Prefs():
   def __init__(self):
     self.prefsDir = os.environ['HOME'] + '/' + '.config'
@@ -258,6 +309,55 @@ def getPrefsLongDescriptions():
         read values from /sys/devices/platform/smapi
       acpi_old:
         read values from /proc/acpi/battery
+      replay:
+        play back a recording of /sys/class/power_supply (see --record)
+          from replayFile, replaySpeed times faster than it was recorded
+          like acpi, but balance commands are only logged, never sent
+      sysfsRoot is prepended to all of these paths, for a copied or fake tree
+        balance commands are only logged when it is set
+    """,
+    "adaptiveDelay": """
+      Choose the delay between updates based on what the batteries are doing,
+        instead of always using delay.
+      The delay drops to adaptiveDelayMin whenever:
+        AC is plugged/unplugged, a battery is inserted/removed,
+        charging state changes, remaining percent changes,
+        power usage changes by more than 20%,
+        or a balancing strategy is within 2% of switching batteries
+      Otherwise, the delay doubles after each update, up to adaptiveDelayMax.
+    """,
+    "balanceHysteresis": """
+      Charge/discharge strategies pick a battery every update.
+      Switching to a battery is held off unless:
+        balanceMinDwell ms have passed since the last switch,
+        some battery percent moved by balanceHysteresis or more
+          since the last switch,
+        and fewer than balanceMaxSwitchesPerHour switches happened
+          in the last hour.
+      Until then, the current battery is kept.
+      Set any of these to 0 to turn that check off.
+      Letting go of the current battery always takes effect immediately,
+        so force-discharge stops right away on AC plug/unplug,
+        battery removal, the system strategy,
+        or when the discharge strategy picks none.
+      The charge strategies never pick none; the last battery picked
+        stays charging until another one is picked.
+      After letting go, the next battery picked skips the
+        balanceHysteresis check, but still waits for balanceMinDwell
+        and balanceMaxSwitchesPerHour.
+    """,
+    "stats": """
+      Time every update, stage by stage, and count the subprocesses started
+        and the sysfs/procfs files read in each update.
+      Stages: prefs, battStatus (read, history and balance within it),
+        actions, publish (daemon and export only) and display.
+      Every statsInterval ms, the totals since startup are written
+        to ~/.cache/tpbattstat/stats-MODE.json, e.g.: stats-daemon.json.
+      Run `tpbattstat.py --stats` to print them as tables:
+        calls, mean, p50/p90/p99 and max in us per stage,
+        and the same per update for each counter.
+      Percentiles are the upper bound of a power of 2 bucket.
+      When off, the instrumentation does nothing.
     """,
     "ledPatternsCharging": ledDescription,
     "ledPatternsDischarging": ledDescription,
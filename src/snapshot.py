@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+from prefs import State, Interface
+
+BATT_SAMPLE_FIELDS = ['batt_id', 'installed', 'state', 'remaining_percent',
+  'power_avg', 'power_now', 'remaining_capacity', 'last_full_capacity',
+  'design_capacity', 'force_discharge', 'inhibit_charge_minutes']
+
+class Immutable(object):
+  __slots__ = []
+  def __setattr__(self, name, val):
+    raise AttributeError(type(self).__name__ + " is immutable")
+  def __delattr__(self, name):
+    raise AttributeError(type(self).__name__ + " is immutable")
+  def setFields(self, names, vals):
+    for (name, val) in zip(names, vals):
+      object.__setattr__(self, name, val)
+
+class BattSample(Immutable):
+  __slots__ = BATT_SAMPLE_FIELDS
+  def __init__(self, batt_id, installed=False, state=State.IDLE,
+               remaining_percent=0, power_avg=0, power_now=0,
+               remaining_capacity=0.0, last_full_capacity=0.0,
+               design_capacity=0.0, force_discharge=False,
+               inhibit_charge_minutes=0):
+    self.setFields(BATT_SAMPLE_FIELDS, [batt_id, bool(installed), state,
+      int(remaining_percent), int(power_avg), int(power_now),
+      float(remaining_capacity), float(last_full_capacity),
+      float(design_capacity), bool(force_discharge),
+      int(inhibit_charge_minutes)])
+  def isInstalled(self):
+    return self.installed
+  def isCharging(self):
+    return self.state == State.CHARGING
+  def isDischarging(self):
+    return self.state == State.DISCHARGING
+  def isForceDischarge(self):
+    return self.force_discharge
+  def isChargeInhibited(self):
+    return self.inhibit_charge_minutes > 0
+  def toDict(self):
+    d = dict()
+    for field in BATT_SAMPLE_FIELDS:
+      d[field] = getattr(self, field)
+    return d
+
+def battSampleFromInfo(battInfo):
+  vals = []
+  for field in BATT_SAMPLE_FIELDS:
+    vals.append(getattr(battInfo, field))
+  return BattSample(*vals)
+
+def battSampleFromDict(d):
+  vals = []
+  for field in BATT_SAMPLE_FIELDS:
+    vals.append(d[field])
+  return BattSample(*vals)
+
+def getTotalRemainingPercent(batts):
+  rem_cap = 0
+  max_cap = 0
+  for batt in batts:
+    if batt.installed:
+      rem_cap = rem_cap + batt.remaining_capacity
+      max_cap = max_cap + batt.last_full_capacity
+  if max_cap <= 0:
+    return 0
+  return int(100 * (rem_cap / max_cap))
+
+def getPowerDisplay(prefs, batts):
+  disp = prefs['displayPowerUsage'].lower()
+  if disp == 'now' and prefs['interface'] != Interface.SMAPI:
+    disp = 'average'
+
+  if disp == 'average':
+    powers = [batt.power_avg for batt in batts]
+  elif disp == 'now':
+    powers = [batt.power_now for batt in batts]
+  else:
+    return ''
+
+  p = 0
+  for power in powers:
+    if power != 0:
+      p = power
+      break
+  return "%.1fW" % (p/1000.0)
+
+MODE_IDLE = 'idle'
+MODE_CHARGING = 'charging'
+MODE_DISCHARGING = 'discharging'
+
+ESTIMATE_FIELDS = ['mode', 'power', 'time_to_empty', 'time_to_full',
+  'batt_times']
+
+class Estimate(Immutable):
+  __slots__ = ESTIMATE_FIELDS
+  def __init__(self, mode=MODE_IDLE, power=None,
+               time_to_empty=None, time_to_full=None, batt_times=None):
+    #batt_times: ((time_to_empty, time_to_full), ...) in seconds
+    #  in the same order as the snapshot batts
+    if batt_times == None:
+      batt_times = ()
+    self.setFields(ESTIMATE_FIELDS, [mode, power, time_to_empty,
+      time_to_full, tuple(batt_times)])
+  def getTimeDisplay(self):
+    if self.mode == MODE_DISCHARGING:
+      return formatDuration(self.time_to_empty)
+    elif self.mode == MODE_CHARGING:
+      return formatDuration(self.time_to_full)
+    else:
+      return ''
+  def toDict(self):
+    return {'mode': self.mode, 'power': self.power,
+      'time_to_empty': self.time_to_empty, 'time_to_full': self.time_to_full,
+      'batt_times': list(self.batt_times)}
+
+def estimateFromDict(d):
+  if d == None:
+    return Estimate()
+  return Estimate(d['mode'], d['power'], d['time_to_empty'],
+    d['time_to_full'], [tuple(t) for t in d['batt_times']])
+
+def formatDuration(seconds):
+  if seconds == None:
+    return ''
+  minutes = int(seconds / 60)
+  return "%d:%02d" % (minutes // 60, minutes % 60)
+
+STATUS_SNAPSHOT_FIELDS = ['ac_connected', 'batts', 'total_percent',
+  'either_installed', 'either_charging', 'either_discharging',
+  'power_display', 'estimate', 'time_display']
+
+class StatusSnapshot(Immutable):
+  __slots__ = STATUS_SNAPSHOT_FIELDS
+  def __init__(self, prefs, ac_connected, batts, estimate=None):
+    if estimate == None:
+      estimate = Estimate()
+    batts = tuple(batts)
+    self.setFields(STATUS_SNAPSHOT_FIELDS, [
+      bool(ac_connected),
+      batts,
+      getTotalRemainingPercent(batts),
+      any(batt.isInstalled() for batt in batts),
+      any(batt.isCharging() for batt in batts),
+      any(batt.isDischarging() for batt in batts),
+      getPowerDisplay(prefs, batts),
+      estimate,
+      estimate.getTimeDisplay(),
+    ])
+  def isACConnected(self):
+    return self.ac_connected
+  def getBatt(self, batt_id):
+    #batts are sorted by id, and are usually BAT0, BAT1, ...
+    if 0 <= batt_id and batt_id < len(self.batts):
+      if self.batts[batt_id].batt_id == batt_id:
+        return self.batts[batt_id]
+    for batt in self.batts:
+      if batt.batt_id == batt_id:
+        return batt
+    return None
+  def toDict(self):
+    return {'ac_connected': self.ac_connected,
+      'batts': [batt.toDict() for batt in self.batts],
+      'estimate': self.estimate.toDict()}
+
+def emptySnapshot(prefs):
+  return StatusSnapshot(prefs, False, [BattSample(0), BattSample(1)])
+
+def snapshotFromDict(prefs, d):
+  batts = [battSampleFromDict(battDict) for battDict in d['batts']]
+  return StatusSnapshot(prefs, d['ac_connected'], batts,
+    estimateFromDict(d.get('estimate')))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+#startup benchmark: spawns tpbattstat.py --json (or --dzen), and measures
+#  the time until the first line is printed and the VmRSS at that point
+#  --gtk imports gtkmod before starting, like every mode did before the
+#  select() loop, for comparing the two (needs gtk installed)
+#  usage: startbench.py [--runs=N] [--mode=json|dzen] [--gtk]
+
+from stats import formatTable
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_RUNS = 5
+DEFAULT_MODE = 'json'
+#long enough that only the first update happens during a run
+FORCE_DELAY = '60000'
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def getCommand(mode, importGtk):
+  args = ['--' + mode, FORCE_DELAY]
+  if not importGtk:
+    return [sys.executable, SRC_DIR + '/tpbattstat.py'] + args
+  return [sys.executable, '-c',
+    'import sys; sys.path.insert(0, ' + repr(SRC_DIR) + '); '
+    + 'sys.argv = ["tpbattstat.py"] + ' + repr(args) + '; '
+    + 'import gtkmod; import tpbattstat; tpbattstat.main()']
+
+def readRssKb(pid):
+  try:
+    f = open('/proc/' + str(pid) + '/status', 'r')
+    lines = f.readlines()
+    f.close()
+  except (IOError, OSError):
+    return None
+  for line in lines:
+    if line.startswith('VmRSS:'):
+      return int(line.split()[1])
+  return None
+
+#returns (seconds to the first line, VmRSS in kB), or None if it died first
+def runOnce(cmd):
+  start = time.time()
+  p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  try:
+    line = p.stdout.readline()
+    elapsed = time.time() - start
+    rss = readRssKb(p.pid)
+  finally:
+    if p.poll() == None:
+      p.kill()
+    (_, err) = p.communicate()
+  if len(line) == 0:
+    sys.stderr.write(err.decode('utf-8', 'replace'))
+    return None
+  return (elapsed, rss)
+
+def usage():
+  return ("Usage:\n"
+    + "  " + sys.argv[0] + " [--runs=N] [--mode=json|dzen] [--gtk]\n"
+    + "    --runs=N     times to start tpbattstat (default " + str(DEFAULT_RUNS) + ")\n"
+    + "    --mode=MODE  json or dzen (default " + DEFAULT_MODE + ")\n"
+    + "    --gtk        import gtkmod first, like before the select() loop\n"
+    )
+
+def main():
+  runs = DEFAULT_RUNS
+  mode = DEFAULT_MODE
+  importGtk = False
+  for arg in sys.argv[1:]:
+    (key, _, val) = arg.partition('=')
+    if key == '--runs' and val.isdigit() and int(val) >= 1:
+      runs = int(val)
+    elif key == '--mode' and val in ['json', 'dzen']:
+      mode = val
+    elif key == '--gtk' and val == '':
+      importGtk = True
+    else:
+      print(usage())
+      return 1
+
+  cmd = getCommand(mode, importGtk)
+  rows = [['run', 'firstLineMs', 'rssMB']]
+  results = []
+  for i in range(runs):
+    result = runOnce(cmd)
+    if result == None:
+      sys.stderr.write("tpbattstat exited before printing a line\n")
+      return 1
+    results.append(result)
+    (elapsed, rss) = result
+    rssMb = '-' if rss == None else "%.1f" % (rss / 1024.0)
+    rows.append([str(i + 1), "%.1f" % (elapsed * 1000), rssMb])
+
+  times = sorted(elapsed for (elapsed, rss) in results)
+  rows.append(['median', "%.1f" % (times[len(times) // 2] * 1000), ''])
+  print(formatTable(rows))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+from prefs import getCacheDir
+from mainloop import monotonic
+import json
+import os
+import sys
+import time
+
+#bucket i holds values with bit_length i: 0, 1, 2-3, 4-7, ... up to ~67s in us
+HISTOGRAM_BUCKETS = 28
+
+def getStatsPath(name):
+  return getCacheDir() + '/stats-' + name + '.json'
+
+def getStatsPaths():
+  cacheDir = getCacheDir()
+  try:
+    names = sorted(os.listdir(cacheDir))
+  except OSError:
+    names = []
+  return [cacheDir + '/' + name for name in names
+    if name.startswith('stats-') and name.endswith('.json')]
+
+#log2-bucketed counts of non-negative ints
+class Histogram():
+  def __init__(self):
+    self.buckets = [0] * HISTOGRAM_BUCKETS
+    self.count = 0
+    self.total = 0
+    self.max = 0
+  def add(self, val):
+    self.buckets[min(val.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+    self.count += 1
+    self.total += val
+    if val > self.max:
+      self.max = val
+  def toDict(self):
+    #upper bound of each bucket => count, empty buckets left out
+    buckets = dict()
+    for (i, n) in enumerate(self.buckets):
+      if n > 0:
+        buckets[str((1 << i) - 1)] = n
+    return {'count': self.count, 'sum': self.total, 'max': self.max,
+      'buckets': buckets}
+
+def getPercentile(histDict, percent):
+  #the upper bound of the bucket the percentile falls in
+  target = histDict['count'] * percent / 100.0
+  seen = 0
+  for bound in sorted(histDict['buckets'].keys(), key=int):
+    seen += histDict['buckets'][bound]
+    if seen >= target:
+      return min(int(bound), histDict['max'])
+  return histDict['max']
+
+#stand-in for Stats when stats are off; every call does nothing
+class NullStats():
+  enabled = False
+  def now(self):
+    return 0
+  def stage(self, name, start):
+    return 0
+  def count(self, name, n=1):
+    pass
+  def endTick(self, start):
+    pass
+
+#per-stage durations in us, and counters summed per tick
+#  stage() returns the time it ended, to start the next stage with
+class Stats():
+  enabled = True
+  def __init__(self, name):
+    self.name = name
+    self.startTime = time.time()
+    self.ticks = 0
+    self.stages = dict()
+    self.counters = dict()
+    self.tickCounters = dict()
+  def now(self):
+    return monotonic()
+  def stage(self, name, start):
+    now = monotonic()
+    hist = self.stages.get(name)
+    if hist == None:
+      hist = self.stages[name] = Histogram()
+    hist.add(int((now - start) * 1000000))
+    return now
+  def count(self, name, n=1):
+    self.tickCounters[name] = self.tickCounters.get(name, 0) + n
+  def endTick(self, start):
+    self.stage('tick', start)
+    self.ticks += 1
+    tickCounters = self.tickCounters
+    self.tickCounters = dict()
+    for name in tickCounters:
+      if name not in self.counters:
+        self.counters[name] = Histogram()
+        #ticks before the first event had none
+        self.counters[name].buckets[0] = self.ticks - 1
+        self.counters[name].count = self.ticks - 1
+    for (name, hist) in self.counters.items():
+      hist.add(tickCounters.get(name, 0))
+  def toDict(self):
+    return {'name': self.name, 'pid': os.getpid(),
+      'start': self.startTime, 'time': time.time(), 'ticks': self.ticks,
+      'stages': dict((k, v.toDict()) for (k, v) in self.stages.items()),
+      'counters': dict((k, v.toDict()) for (k, v) in self.counters.items())}
+  def getSummary(self):
+    tick = self.stages.get('tick')
+    if tick == None:
+      return 'stats: no ticks'
+    tick = tick.toDict()
+    s = "stats: %d ticks, tick p50<=%dus p99<=%dus max=%dus" % (self.ticks,
+      getPercentile(tick, 50), getPercentile(tick, 99), tick['max'])
+    for name in sorted(self.counters.keys()):
+      s += ", %s=%d" % (name, self.counters[name].total)
+    return s
+  def dump(self, path):
+    statsDir = os.path.dirname(path)
+    if not os.path.isdir(statsDir):
+      os.makedirs(statsDir, 0o755)
+    tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+    f = open(tmpPath, 'w')
+    json.dump(self.toDict(), f, sort_keys=True)
+    f.close()
+    os.rename(tmpPath, path)
+
+STATS = NullStats()
+
+def getStats():
+  return STATS
+
+def setStats(stats):
+  global STATS
+  STATS = stats
+
+#right-aligned columns, for the command line tools
+def formatTable(rows):
+  widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+  lines = []
+  for row in rows:
+    lines.append('  '.join(
+      cell.rjust(w) for (cell, w) in zip(row, widths)).rstrip())
+  return "\n".join(lines)
+
+def formatHistRows(hists):
+  rows = []
+  for name in sorted(hists.keys()):
+    h = hists[name]
+    mean = 0
+    if h['count'] > 0:
+      mean = h['sum'] / float(h['count'])
+    rows.append([name, str(h['count']), "%.1f" % mean,
+      str(getPercentile(h, 50)), str(getPercentile(h, 90)),
+      str(getPercentile(h, 99)), str(h['max']), str(h['sum'])])
+  return rows
+
+def formatStats(d):
+  age = time.time() - d['time']
+  s = ("%s (pid %d): %d ticks, dumped %ds ago\n"
+    % (d['name'], d['pid'], d['ticks'], age))
+  header = ['mean', 'p50', 'p90', 'p99', 'max', 'total']
+  if len(d['stages']) > 0:
+    rows = [['stage (us)', 'calls'] + header] + formatHistRows(d['stages'])
+    s += formatTable(rows) + "\n"
+  if len(d['counters']) > 0:
+    rows = [['per tick', 'ticks'] + header] + formatHistRows(d['counters'])
+    s += formatTable(rows) + "\n"
+  return s
+
+def printStats(asJson=False):
+  paths = getStatsPaths()
+  if len(paths) == 0:
+    sys.stderr.write("no stats in " + getCacheDir()
+      + ", set stats = true in prefs\n")
+    return 1
+  for path in paths:
+    try:
+      f = open(path, 'r')
+      d = json.load(f)
+      f.close()
+    except (IOError, OSError, ValueError) as e:
+      sys.stderr.write("could not read " + path + ": " + str(e) + "\n")
+      continue
+    if asJson:
+      print(json.dumps(d, sort_keys=True))
+    else:
+      print(formatStats(d))
+  return 0
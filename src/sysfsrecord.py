@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import time
+
+RECORD_VERSION = 1
+POWER_SUPPLY_DIR = '/sys/class/power_supply'
+
+#a recording is one json object per line:
+#  {"version": 1, "dir": "/sys/class/power_supply"}
+#  {"t": seconds since start, "files": {"BAT0/energy_now": "41230000\n", ...}}
+#each frame only has the files that changed since the previous frame,
+#  with null for files that went away
+
+def readSupplyFiles(supplyDir):
+  files = dict()
+  try:
+    supplies = os.listdir(supplyDir)
+  except OSError:
+    return files
+  for supply in supplies:
+    try:
+      names = os.listdir(supplyDir + '/' + supply)
+    except OSError:
+      continue
+    for name in names:
+      path = supplyDir + '/' + supply + '/' + name
+      if not os.path.isfile(path):
+        continue
+      try:
+        f = open(path, 'r')
+        files[supply + '/' + name] = f.read()
+        f.close()
+      except (IOError, OSError):
+        pass
+  return files
+
+class SysfsRecorder():
+  def __init__(self, path, root=''):
+    self.supplyDir = root + POWER_SUPPLY_DIR
+    self.out = open(path, 'w')
+    self.out.write(json.dumps({'version': RECORD_VERSION,
+      'dir': POWER_SUPPLY_DIR}) + "\n")
+    self.files = dict()
+    self.start = None
+  def record(self):
+    now = time.time()
+    if self.start == None:
+      self.start = now
+    files = readSupplyFiles(self.supplyDir)
+    changed = dict()
+    for name in files:
+      if self.files.get(name) != files[name]:
+        changed[name] = files[name]
+    for name in self.files:
+      if name not in files:
+        changed[name] = None
+    self.files = files
+    self.out.write(json.dumps({'t': now - self.start, 'files': changed}) + "\n")
+    self.out.flush()
+  def close(self):
+    self.out.close()
+
+#writes a recording into a temp dir as it plays, so the normal readers
+#  (and their cached fds) see the files change like real sysfs
+class SysfsReplayer():
+  def __init__(self, path, speed, clock=time.time):
+    self.speed = max(speed, 1)
+    self.clock = clock
+    self.frames = []
+    f = open(path, 'r')
+    header = json.loads(f.readline())
+    if header.get('version') != RECORD_VERSION:
+      f.close()
+      raise Exception("unknown recording version: " + path)
+    for line in f:
+      if line.strip() != '':
+        self.frames.append(json.loads(line))
+    f.close()
+
+    self.root = tempfile.mkdtemp(prefix='tpbattstat-replay-')
+    atexit.register(self.close)
+    self.supplyDir = self.root + header['dir']
+    os.makedirs(self.supplyDir)
+    self.index = 0
+    self.start = self.clock()
+    self.advance()
+  def getReplayTime(self):
+    return (self.clock() - self.start) * self.speed
+  def isFinished(self):
+    return self.index >= len(self.frames)
+  def advance(self):
+    t = self.getReplayTime()
+    while not self.isFinished() and self.frames[self.index]['t'] <= t:
+      self.applyFrame(self.frames[self.index])
+      self.index += 1
+  def applyFrame(self, frame):
+    for (name, content) in frame['files'].items():
+      path = self.supplyDir + '/' + name
+      if content == None:
+        if os.path.isfile(path):
+          os.remove(path)
+        continue
+      supplyDir = os.path.dirname(path)
+      if not os.path.isdir(supplyDir):
+        os.makedirs(supplyDir)
+      #rewrite in place, so an fd kept open by a reader sees the change
+      f = open(path, 'w')
+      f.write(content)
+      f.close()
+  def close(self):
+    shutil.rmtree(self.root, True)
+
+def record(path, intervalMs, durationS, root=''):
+  recorder = SysfsRecorder(path, root)
+  start = time.time()
+  try:
+    while durationS == None or time.time() - start < durationS:
+      recorder.record()
+      time.sleep(intervalMs / 1000.0)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    recorder.close()
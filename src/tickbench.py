@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+#microbenchmarks for one update tick, timed stage by stage
+#  runs the real prefs/battstatus/balance/actions/markup/gui code
+#  against a fake sysfs tree that changes every tick, with a throwaway HOME
+#  usage: tickbench.py [--ticks=N] [--batts=N] [--save[=FILE]]
+#                      [--compare[=FILE]] [PREF=VALUE ...]
+
+from prefs import Prefs
+from battstatus import BattStatus, ACPI_DIR
+from guimarkup import GuiMarkupPrinter
+from actions import Actions
+from prefs import getCacheDir
+from stats import formatTable
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+DEFAULT_TICKS = 2000
+DEFAULT_COUNT_TICKS = 200
+DEFAULT_BATTS = 2
+WARMUP_TICKS = 20
+#a stage regresses when its median is this many percent over the baseline
+#  and also at least REGRESSION_MIN_NS slower, so sub-us stages dont flap
+REGRESSION_PERCENT = 50
+REGRESSION_MIN_NS = 5000
+#timings only compare on the machine they were saved on, so --save goes to
+#  the cache dir; the baseline next to this file only has syscall counts,
+#  which carry over, and is used when there is no local one
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  'tickbench-baseline.json')
+def getLocalBaselineFile():
+  return getCacheDir() + '/tickbench-baseline.json'
+
+PROC_IO = '/proc/self/io'
+
+#stages are timed in the order they run in TPBattStat.update
+#  BattInfo.update and BattBalance.update run inside BattStatus.update
+STAGES = [
+  'Prefs.update',
+  'BattStatus.update',
+  'BattInfo.update',
+  'BattBalance.update',
+  'Actions.updateLed',
+  'getMarkupJson',
+  'getMarkupDzen',
+  'Gui.update',
+]
+
+#two discharging batteries draining at different rates, AC toggling
+class FakeSysfs():
+  def __init__(self, battCount):
+    self.root = tempfile.mkdtemp(prefix='tpbattstat-bench-')
+    self.dir = self.root + ACPI_DIR
+    self.battCount = battCount
+    self.tick = 0
+    for batt_id in range(battCount):
+      battDir = self.battDir(batt_id)
+      os.makedirs(battDir)
+      self.write(battDir + '/present', 1)
+      self.write(battDir + '/voltage_now', 12000000)
+      self.write(battDir + '/energy_full', 50000000)
+      self.write(battDir + '/energy_full_design', 57000000)
+      self.write(battDir + '/charge_behaviour', '[auto] inhibit-charge force-discharge')
+    os.makedirs(self.dir + '/AC')
+    self.step()
+  def battDir(self, batt_id):
+    return self.dir + '/BAT' + str(batt_id)
+  def write(self, path, val):
+    f = open(path, 'w')
+    f.write(str(val) + "\n")
+    f.close()
+  def step(self):
+    online = (self.tick // 600) % 2
+    self.write(self.dir + '/AC/online', online)
+    for batt_id in range(self.battCount):
+      battDir = self.battDir(batt_id)
+      drain = (self.tick * (batt_id + 1) * 3000) % 45000000
+      if online:
+        self.write(battDir + '/status', 'Charging')
+      else:
+        self.write(battDir + '/status', 'Discharging')
+      self.write(battDir + '/energy_now', 50000000 - drain)
+      self.write(battDir + '/power_now', 9000000 + 1000 * (self.tick % 97))
+    self.tick += 1
+  def close(self):
+    shutil.rmtree(self.root, True)
+
+#read()/write() syscalls so far, from /proc/self/io; None when unavailable
+#  overhead is what each read of /proc/self/io adds to the count
+class SyscallCounter():
+  def __init__(self):
+    try:
+      self.fd = os.open(PROC_IO, os.O_RDONLY)
+    except OSError:
+      self.fd = None
+    self.overhead = 0
+    self.reads = 0
+    if self.fd != None:
+      before = self.read()
+      for i in range(10):
+        after = self.read()
+      self.overhead = (after - before) / 10.0
+  def read(self):
+    if self.fd == None:
+      return None
+    self.reads += 1
+    count = 0
+    for line in os.pread(self.fd, 4096, 0).decode('utf-8').splitlines():
+      (key, _, val) = line.partition(':')
+      if key == 'syscr' or key == 'syscw':
+        count += int(val)
+    return count
+  def close(self):
+    if self.fd != None:
+      os.close(self.fd)
+      self.fd = None
+
+class StageStats():
+  def __init__(self, name):
+    self.name = name
+    self.times = []
+    self.syscalls = []
+    self.allocs = []
+    self.peak = 0
+  def getPercentile(self, vals, percent):
+    if len(vals) == 0:
+      return None
+    vals = sorted(vals)
+    i = min(int(len(vals) * percent / 100.0), len(vals) - 1)
+    return vals[i]
+  def getMean(self, vals):
+    if len(vals) == 0:
+      return None
+    return sum(vals) / float(len(vals))
+  def toDict(self):
+    return {'p50': self.getPercentile(self.times, 50),
+      'p90': self.getPercentile(self.times, 90),
+      'p99': self.getPercentile(self.times, 99),
+      'max': self.getPercentile(self.times, 100),
+      'syscalls': self.getMean(self.syscalls),
+      'allocBytes': self.getMean(self.allocs)}
+
+#wraps stage functions; times every call, and when counting is on,
+#  also records syscalls and the tracemalloc high-water mark above the start
+#  nested stages report their peak to the enclosing stage
+class StageTimer():
+  def __init__(self):
+    self.stats = dict((name, StageStats(name)) for name in STAGES)
+    self.counter = SyscallCounter()
+    self.counting = False
+    self.recording = False
+    self.stack = []
+  def wrap(self, name, fct):
+    stats = self.stats[name]
+    def timed(*args, **kwargs):
+      start = self.begin(stats)
+      try:
+        return fct(*args, **kwargs)
+      finally:
+        self.end(stats, start)
+    return timed
+  def begin(self, stats):
+    syscalls = None
+    mem = None
+    if self.counting:
+      if len(self.stack) > 0:
+        parent = self.stack[-1]
+        parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+      syscalls = self.counter.read()
+      tracemalloc.reset_peak()
+      mem = tracemalloc.get_traced_memory()[0]
+      stats.peak = mem
+    self.stack.append(stats)
+    return (time.perf_counter_ns(), syscalls, mem, self.counter.reads)
+  def end(self, stats, start):
+    elapsed = time.perf_counter_ns() - start[0]
+    self.stack.pop()
+    if self.counting:
+      stats.peak = max(stats.peak, tracemalloc.get_traced_memory()[1])
+      syscalls = self.counter.read()
+      if len(self.stack) > 0:
+        parent = self.stack[-1]
+        parent.peak = max(parent.peak, stats.peak)
+      if self.recording:
+        if syscalls != None:
+          reads = self.counter.reads - start[3]
+          stats.syscalls.append(
+            syscalls - start[1] - reads * self.counter.overhead)
+        stats.allocs.append(stats.peak - start[2])
+    elif self.recording:
+      stats.times.append(elapsed)
+
+class TickBench():
+  def __init__(self, battCount, overrides):
+    self.fakeSysfs = FakeSysfs(battCount)
+    self.home = tempfile.mkdtemp(prefix='tpbattstat-bench-home-')
+    os.environ['HOME'] = self.home
+    os.environ.pop('XDG_CACHE_HOME', None)
+    self.writePrefsFile(overrides)
+
+    self.timer = StageTimer()
+    self.prefs = Prefs()
+    self.battStatus = BattStatus(self.prefs)
+    self.actions = Actions(self.prefs, self.battStatus)
+    self.printer = GuiMarkupPrinter(self.prefs, self.battStatus, None)
+    self.gui = self.newGui()
+
+    wrap = self.timer.wrap
+    self.prefsUpdate = wrap('Prefs.update', self.prefs.update)
+    self.battStatusUpdate = wrap('BattStatus.update', self.battStatus.update)
+    self.battStatus.battBalance.update = wrap('BattBalance.update',
+      self.battStatus.battBalance.update)
+    self.updateLed = wrap('Actions.updateLed', self.actions.updateLed)
+    self.getMarkupJson = wrap('getMarkupJson', self.printer.getMarkupJson)
+    self.getMarkupDzen = wrap('getMarkupDzen', self.printer.getMarkupDzen)
+    self.guiUpdate = None
+    if self.gui != None:
+      self.guiUpdate = wrap('Gui.update', self.gui.update)
+    self.wrappedBatts = []
+  def writePrefsFile(self, overrides):
+    prefsDir = self.home + '/.config'
+    os.makedirs(prefsDir)
+    f = open(prefsDir + '/tpbattstat.conf', 'w')
+    f.write("interface = acpi\n")
+    #history is off by default, but the hot loop should cover it
+    f.write("historySize = 3600\n")
+    f.write("sysfsRoot = " + self.fakeSysfs.root + "\n")
+    for (key, val) in overrides:
+      f.write(key + " = " + val + "\n")
+    f.close()
+  def newGui(self):
+    try:
+      from gui import Gui
+      return Gui(self.prefs, self.battStatus)
+    except Exception as e:
+      sys.stderr.write("skipping Gui.update, no gtk: " + str(e) + "\n")
+      return None
+  def wrapBatts(self):
+    #batteries are recreated on discovery and on backend changes
+    batts = self.battStatus.batts
+    if self.wrappedBatts != batts:
+      for batt in batts:
+        if batt not in self.wrappedBatts:
+          batt.update = self.timer.wrap('BattInfo.update', batt.update)
+      self.wrappedBatts = list(batts)
+  def tick(self):
+    self.fakeSysfs.step()
+    self.prefsUpdate()
+    self.battStatusUpdate(self.prefs)
+    self.updateLed()
+    self.getMarkupJson()
+    self.getMarkupDzen()
+    if self.guiUpdate != None:
+      self.guiUpdate()
+    self.wrapBatts()
+  def run(self, ticks, countTicks):
+    for i in range(WARMUP_TICKS):
+      self.tick()
+
+    self.timer.recording = True
+    for i in range(ticks):
+      self.tick()
+
+    tracemalloc.start()
+    self.timer.counting = True
+    for i in range(countTicks):
+      self.tick()
+
+    #memory kept across ticks, without the bench appending samples
+    self.timer.counting = False
+    self.timer.recording = False
+    retainedStart = tracemalloc.get_traced_memory()[0]
+    for i in range(countTicks):
+      self.tick()
+    retained = tracemalloc.get_traced_memory()[0] - retainedStart
+    tracemalloc.stop()
+    return retained / float(countTicks)
+  def getResults(self):
+    results = dict()
+    for name in STAGES:
+      if len(self.timer.stats[name].times) > 0:
+        results[name] = self.timer.stats[name].toDict()
+    return results
+  def close(self):
+    self.battStatus.closeBackend()
+    if self.battStatus.history != None:
+      self.battStatus.history.close()
+    self.timer.counter.close()
+    self.fakeSysfs.close()
+    shutil.rmtree(self.home, True)
+
+def formatUs(ns):
+  if ns == None:
+    return '-'
+  return "%.1f" % (ns / 1000.0)
+
+def formatCount(count):
+  if count == None:
+    return '-'
+  return "%.1f" % count
+
+def isRegression(result, base):
+  if 'p50' not in base:
+    slower = False
+  elif result['p50'] <= base['p50'] * (1 + REGRESSION_PERCENT / 100.0):
+    slower = False
+  else:
+    slower = result['p50'] - base['p50'] >= REGRESSION_MIN_NS
+  moreSyscalls = (result['syscalls'] != None and base['syscalls'] != None
+    and result['syscalls'] > base['syscalls'] + 0.5)
+  return slower or moreSyscalls
+
+def getRows(results, baseline):
+  header = ['stage', 'p50us', 'p90us', 'p99us', 'maxus', 'syscalls', 'allocB']
+  if baseline != None:
+    header += ['baseP50us', 'baseSyscalls', '']
+  rows = [header]
+  regressions = []
+  for name in STAGES:
+    if name not in results:
+      continue
+    r = results[name]
+    row = [name, formatUs(r['p50']), formatUs(r['p90']), formatUs(r['p99']),
+      formatUs(r['max']), formatCount(r['syscalls']),
+      formatCount(r['allocBytes'])]
+    if baseline != None:
+      base = baseline['stages'].get(name)
+      if base == None:
+        row += ['-', '-', 'new']
+      else:
+        mark = ''
+        if isRegression(r, base):
+          mark = 'REGRESSED'
+          regressions.append(name)
+        row += [formatUs(base.get('p50')), formatCount(base['syscalls']), mark]
+    rows.append(row)
+  return (rows, regressions)
+
+def readBaseline(path):
+  f = open(path, 'r')
+  baseline = json.load(f)
+  f.close()
+  return baseline
+
+def writeBaseline(path, results, ticks, battCount, syscallsOnly):
+  if syscallsOnly:
+    results = dict((name, {'syscalls': r['syscalls']})
+      for (name, r) in results.items())
+  baselineDir = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(baselineDir):
+    os.makedirs(baselineDir, 0o755)
+  f = open(path, 'w')
+  json.dump({'ticks': ticks, 'batts': battCount,
+    'python': sys.version.split()[0], 'stages': results},
+    f, indent=2, sort_keys=True)
+  f.write("\n")
+  f.close()
+
+def usage():
+  return ("Usage:\n"
+    + "  " + sys.argv[0] + " [OPTS] [PREF=VALUE ...]\n"
+    + "    --ticks=N         timed ticks (default " + str(DEFAULT_TICKS) + ")\n"
+    + "    --count-ticks=N   ticks with syscall/allocation counting"
+    + " (default " + str(DEFAULT_COUNT_TICKS) + ")\n"
+    + "    --batts=N         batteries in the fake sysfs"
+    + " (default " + str(DEFAULT_BATTS) + ")\n"
+    + "    --save[=FILE]     store the results as the baseline, FILE defaults to\n"
+    + "                        " + getLocalBaselineFile() + "\n"
+    + "    --syscalls-only   only store syscall counts, which carry over between\n"
+    + "                        machines, e.g. for " + BASELINE_FILE + "\n"
+    + "    --compare[=FILE]  compare against the baseline, exit 1 on regression\n"
+    + "                        FILE defaults to the --save one if it exists,\n"
+    + "                        or else the syscall-only one next to this script\n"
+    + "                        timings only mean something on the machine\n"
+    + "                        that saved them, so --save before comparing them\n"
+    + "    PREF=VALUE        override a pref, e.g.: displayOnlyOneIcon=false\n"
+    + "                      interface=replay replayFile=FILE benchmarks a recording\n"
+    + "\n"
+    + "  latencies are per call in us; BattInfo.update is per battery,\n"
+    + "    and BattInfo/BattBalance are also included in BattStatus.update\n"
+    + "  syscalls: read()+write() syscalls per call, from " + PROC_IO + "\n"
+    + "  allocB: bytes allocated above the start of the call, at its peak\n"
+    + "  a stage regresses when its p50 is " + str(REGRESSION_PERCENT)
+    + "% (and " + formatUs(REGRESSION_MIN_NS) + "us) slower,\n"
+    + "    or when it makes more syscalls than the baseline\n"
+    )
+
+def main():
+  ticks = DEFAULT_TICKS
+  countTicks = DEFAULT_COUNT_TICKS
+  battCount = DEFAULT_BATTS
+  savePath = None
+  syscallsOnly = False
+  comparePath = None
+  overrides = []
+  for arg in sys.argv[1:]:
+    (key, _, val) = arg.partition('=')
+    if key == '--ticks':
+      ticks = int(val)
+    elif key == '--count-ticks':
+      countTicks = int(val)
+    elif key == '--batts':
+      battCount = int(val)
+    elif key == '--save':
+      savePath = val or getLocalBaselineFile()
+    elif key == '--syscalls-only' and val == '':
+      syscallsOnly = True
+    elif key == '--compare':
+      comparePath = val
+      if comparePath == '':
+        comparePath = getLocalBaselineFile()
+        if not os.path.isfile(comparePath):
+          comparePath = BASELINE_FILE
+    elif not key.startswith('-') and val != '':
+      overrides.append((key, val))
+    else:
+      print(usage())
+      return 1
+
+  baseline = None
+  if comparePath != None:
+    baseline = readBaseline(comparePath)
+    sys.stderr.write("comparing against " + comparePath + "\n")
+    if baseline['batts'] != battCount:
+      sys.stderr.write("WARNING: baseline has %d batteries, not %d\n"
+        % (baseline['batts'], battCount))
+
+  bench = TickBench(battCount, overrides)
+  try:
+    start = time.time()
+    retained = bench.run(ticks, countTicks)
+    elapsed = time.time() - start
+    results = bench.getResults()
+  finally:
+    bench.close()
+
+  (rows, regressions) = getRows(results, baseline)
+  print(formatTable(rows))
+  sys.stderr.write("%d ticks, %d batteries in %.1fs, %.1f bytes retained/tick\n"
+    % (ticks, battCount, elapsed, retained))
+
+  if savePath != None:
+    writeBaseline(savePath, results, ticks, battCount, syscallsOnly)
+    sys.stderr.write("saved baseline to " + savePath + "\n")
+  if len(regressions) > 0:
+    sys.stderr.write("regressed: " + ", ".join(regressions) + "\n")
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
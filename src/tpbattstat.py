@@ -20,36 +20,130 @@
 ##########################################################################
 
 from prefs import Prefs
-from gui import Gui
-from gtkmod import GTK_MOD
-from battstatus import BattStatus
+from battstatus import BattStatus, BattStatusRemote
 from guimarkup import GuiMarkupPrinter
 from actions import Actions
+from mainloop import GtkLoop, SelectLoop, monotonic
+from uevent import UeventMonitor
+from daemon import SnapshotServer, connectClient
+from metrics import (
+  MetricsServer, MetricsSample, getMetricsSocketPath, DEFAULT_METRICS_PORT)
+from sysfsrecord import record
+from stats import Stats, NullStats, getStats, setStats, getStatsPath, printStats
 import sys
+import time
+
+NEAR_THRESHOLD_PERCENT = 2
+POWER_CHANGE_RATIO = 0.2
+DAEMON_RECONNECT_DELAY = 2000
+RECORD_INTERVAL = 1000
+
+class UpdateScheduler():
+  def __init__(self, prefs, battStatus):
+    self.prefs = prefs
+    self.battStatus = battStatus
+    self.lastSample = None
+    self.delay = None
+  def getSample(self):
+    snapshot = self.battStatus.snapshot
+    sample = [snapshot.isACConnected()]
+    for batt in snapshot.batts:
+      sample.append(batt.isInstalled())
+      sample.append(batt.state)
+      sample.append(batt.remaining_percent)
+      sample.append(batt.power_avg)
+    return sample
+  def isPowerChange(self, prevPower, power):
+    return abs(power - prevPower) > POWER_CHANGE_RATIO * abs(prevPower)
+  def isActive(self, prev, cur):
+    if prev == None or len(prev) != len(cur):
+      return True
+    if prev[0] != cur[0]:
+      return True
+    for i in range(1, len(cur), 4):
+      (installed, state, percent, power) = cur[i:i+4]
+      (prevInstalled, prevState, prevPercent, prevPower) = prev[i:i+4]
+      if (False
+        or installed != prevInstalled
+        or state != prevState
+        or percent != prevPercent
+        or self.isPowerChange(prevPower, power)
+        ): return True
+    margin = self.battStatus.battBalance.getDecisionMargin()
+    return margin != None and margin <= NEAR_THRESHOLD_PERCENT
+  def nextDelay(self):
+    minDelay = max(self.prefs['adaptiveDelayMin'], 100)
+    maxDelay = max(self.prefs['adaptiveDelayMax'], minDelay)
+    sample = self.getSample()
+    if self.delay == None or self.isActive(self.lastSample, sample):
+      self.delay = minDelay
+    else:
+      self.delay = self.delay * 2
+    self.delay = min(max(self.delay, minDelay), maxDelay)
+    self.lastSample = sample
+    return self.delay
 
 class TPBattStat():
-  def __init__(self, mode, forceDelay=None, forceIconSize=None):
+  def __init__(self, mode, forceDelay=None, forceIconSize=None,
+               exportAddr=None):
     self.mode = mode
     self.forceDelay = forceDelay
+    if self.isGtkMode():
+      self.loop = GtkLoop()
+    else:
+      self.loop = SelectLoop()
+    self.timeoutId = None
+    self.uevents = None
+    self.ueventWatchId = None
+    self.server = None
+    self.client = None
+    self.exporter = None
+    self.updates = 0
+    self.lastStatsDump = None
 
     self.prefs = Prefs()
-    self.battStatus = BattStatus(self.prefs)
+    if (self.mode == "gtk" or self.mode == "json" or self.mode == "dzen"
+        or self.mode == "export"):
+      self.client = connectClient()
+    try:
+      if self.mode == "daemon":
+        self.server = SnapshotServer()
+      if self.mode == "export":
+        self.exporter = MetricsServer(self.loop, exportAddr)
+    except Exception as e:
+      sys.stderr.write(str(e) + "\n")
+      sys.exit(1)
+
+    if self.client != None:
+      self.battStatus = BattStatusRemote(self.prefs)
+    else:
+      self.battStatus = BattStatus(self.prefs)
+    self.scheduler = UpdateScheduler(self.prefs, self.battStatus)
     self.actions = Actions(self.prefs, self.battStatus)
-    if self.mode == "gtk" or self.mode == "prefs":
+    if self.isGtkMode():
+      from gui import Gui
       self.gui = Gui(self.prefs, self.battStatus)
     elif self.mode == "json" or self.mode == "dzen":
       self.guiMarkupPrinter = GuiMarkupPrinter(
         self.prefs, self.battStatus, forceIconSize)
 
+  def isGtkMode(self):
+    return self.mode == "gtk" or self.mode == "prefs"
   def getGui(self):
     return self.gui
   def startUpdate(self):
-    self.curDelay = -1
-    self.update()
+    if self.server != None:
+      self.loop.ioAddWatch(self.server.fileno(), self.server.acceptClients)
+    if self.exporter != None:
+      self.loop.ioAddWatch(self.exporter.fileno(), self.exporter.acceptClients)
+    if self.client != None:
+      self.loop.ioAddWatch(self.client.fileno(), self.onSnapshot)
+    else:
+      self.update()
   def onClickEvent(self, widget, event):
     if event.button == 1:
       self.getGui().showPreferencesDialog()
-  def update(self):
+  def updatePrefs(self):
     try:
       self.prefs.update()
     except Exception as e:
@@ -57,9 +151,93 @@ class TPBattStat():
       print(str(e))
     if self.forceDelay != None:
       self.prefs['delay'] = self.forceDelay
+  def update(self):
+    stats = getStats()
+    start = stats.now()
+    if self.exporter != None:
+      updateStart = monotonic()
+    self.updatePrefs()
+    t = stats.stage('prefs', start)
     self.battStatus.update(self.prefs)
+    t = stats.stage('battStatus', t)
 
     self.actions.performActions()
+    t = stats.stage('actions', t)
+    if self.exporter != None:
+      self.publishMetrics(monotonic() - updateStart)
+      t = stats.stage('publish', t)
+    if self.server != None:
+      self.server.publish(self.battStatus.snapshot.toDict())
+      t = stats.stage('publish', t)
+    self.updateDisplay()
+    stats.stage('display', t)
+    stats.endTick(start)
+    self.updateStats()
+
+    self.updateUevents()
+    self.scheduleUpdate(self.getDelay())
+    return False
+  def publishMetrics(self, updateSeconds):
+    self.updates += 1
+    balance = self.battStatus.battBalance
+    self.exporter.publish(MetricsSample(self.battStatus.snapshot,
+      [('charge', balance.chargeGovernor.getCounts()),
+       ('discharge', balance.dischargeGovernor.getCounts())],
+      updateSeconds, self.updates))
+  def onSnapshot(self):
+    snapshot = self.client.readSnapshot()
+    if snapshot != None:
+      stats = getStats()
+      start = stats.now()
+      self.updatePrefs()
+      t = stats.stage('prefs', start)
+      self.battStatus.loadSnapshot(snapshot)
+      if self.exporter != None:
+        #the daemon does the balancing, only its readings are known here
+        self.exporter.publish(MetricsSample(self.battStatus.snapshot))
+      self.updateDisplay()
+      stats.stage('display', t)
+      stats.endTick(start)
+      self.updateStats()
+    if self.client.closed:
+      sys.stderr.write("lost connection to daemon, reconnecting" + "\n")
+      self.battStatus.loadSnapshot(None)
+      if self.exporter != None:
+        self.exporter.publish(None)
+      self.updateDisplay()
+      self.timeoutId = self.loop.timeoutAdd(
+        DAEMON_RECONNECT_DELAY, self.reconnect)
+      return False
+    return True
+  def reconnect(self):
+    self.client = connectClient()
+    if self.client == None:
+      return True
+    self.timeoutId = None
+    self.loop.ioAddWatch(self.client.fileno(), self.onSnapshot)
+    return False
+  def updateStats(self):
+    stats = getStats()
+    if self.prefs['stats'] and not stats.enabled:
+      setStats(Stats(self.mode))
+      self.lastStatsDump = time.time()
+    elif not self.prefs['stats'] and stats.enabled:
+      self.dumpStats()
+      setStats(NullStats())
+    elif stats.enabled:
+      interval = max(self.prefs['statsInterval'], 1000) / 1000.0
+      if time.time() - self.lastStatsDump >= interval:
+        self.dumpStats()
+  def dumpStats(self):
+    stats = getStats()
+    self.lastStatsDump = time.time()
+    try:
+      stats.dump(getStatsPath(self.mode))
+    except (IOError, OSError) as e:
+      sys.stderr.write("could not write stats: " + str(e) + "\n")
+    if self.prefs['statsStderr']:
+      sys.stderr.write(stats.getSummary() + "\n")
+  def updateDisplay(self):
     if self.mode == "gtk":
       self.gui.update()
     elif self.mode == "json" or self.mode == "dzen":
@@ -68,22 +246,58 @@ class TPBattStat():
           markup = self.guiMarkupPrinter.getMarkupJson()
         elif self.mode == "dzen":
           markup = self.guiMarkupPrinter.getMarkupDzen()
-        print(markup)
-        sys.stdout.flush()
+        if markup != None:
+          print(markup)
+          sys.stdout.flush()
       except IOError:
         sys.stderr.write("STDOUT is broken, assuming external gui is dead" + "\n")
         sys.exit(1)
-
-    if self.prefs['delay'] != self.curDelay:
-      self.curDelay = self.prefs['delay']
-      if self.curDelay <= 0:
-        self.curDelay = 1000
-      GTK_MOD.TIMEOUT_ADD_FCT(self.curDelay, self.update)
-      return False
+  def getDelay(self):
+    if self.prefs['adaptiveDelay'] and self.forceDelay == None:
+      return self.scheduler.nextDelay()
+    elif self.uevents != None:
+      delay = self.prefs['ueventDelay']
     else:
-      return True
+      delay = self.prefs['delay']
+    if delay <= 0:
+      delay = 1000
+    return delay
+  def scheduleUpdate(self, delay):
+    if self.timeoutId != None:
+      self.loop.sourceRemove(self.timeoutId)
+    self.timeoutId = self.loop.timeoutAdd(delay, self.onTimeout)
+  def onTimeout(self):
+    self.timeoutId = None
+    self.update()
+    return False
+  def updateUevents(self):
+    if self.prefs['useUevents'] and self.uevents == None:
+      try:
+        self.uevents = UeventMonitor()
+        self.ueventWatchId = self.loop.ioAddWatch(
+          self.uevents.fileno(), self.onUevent)
+      except Exception as e:
+        sys.stderr.write("could not listen for uevents: " + str(e) + "\n")
+        self.uevents = None
+    elif not self.prefs['useUevents'] and self.uevents != None:
+      self.loop.sourceRemove(self.ueventWatchId)
+      self.uevents.close()
+      self.uevents = None
+      self.ueventWatchId = None
+  def onUevent(self):
+    if self.uevents == None:
+      return False
+    if len(self.uevents.readEvents()) > 0:
+      self.update()
+    return True
+
+#json/dzen/daemon never import gtk, so it is only loaded here
+def getGtkMod():
+  from gtkmod import GTK_MOD
+  return GTK_MOD
 
 def showAndExit(gtkElem):
+  GTK_MOD = getGtkMod()
   gtkElem.connect("destroy", GTK_MOD.GTK.main_quit)
   gtkElem.show_all()
   GTK_MOD.GTK.main()
@@ -98,9 +312,30 @@ def usage(name, cmds):
     + " " + name + " " + formatCmd(cmds['json']) + " [delay-ms] [icon-size]\n"
     + " " + name + " " + formatCmd(cmds['dzen']) + " [delay-ms] [icon-size]\n"
     + " " + name + " " + formatCmd(cmds['prefs']) + "\n"
+    + " " + name + " " + formatCmd(cmds['daemon']) + " [delay-ms]\n"
+    + " " + name + " " + formatCmd(cmds['record']) + " FILE [interval-ms] [duration-s]\n"
+    + " " + name + " " + formatCmd(cmds['stats']) + " [json]\n"
+    + " " + name + " " + formatCmd(cmds['export']) + " [ADDR] [delay-ms]\n"
     + "\n"
-    + "   delay-ms: override the delay in prefs\n"
+    + "   delay-ms: override the delay in prefs, and turn off adaptiveDelay\n"
     + "   icon-size: override the icon-size in prefs\n"
+    + "\n"
+    + "   daemon polls the batteries, balances them, and publishes the\n"
+    + "     readings on a unix socket. while it is running, window/json/dzen\n"
+    + "     only display what the daemon publishes\n"
+    + "\n"
+    + "   record saves /sys/class/power_supply to FILE every interval-ms\n"
+    + "     (default " + str(RECORD_INTERVAL) + "), until duration-s or Ctrl+C.\n"
+    + "     play it back with interface=replay and replayFile=FILE in prefs\n"
+    + "\n"
+    + "   stats prints per-stage timings and counters written by running\n"
+    + "     instances with stats = true in prefs, or the raw json\n"
+    + "\n"
+    + "   export serves the readings as OpenMetrics text over http on ADDR:\n"
+    + "     a unix socket path (default " + getMetricsSocketPath() + "),\n"
+    + "     or [HOST:]PORT, e.g.: " + str(DEFAULT_METRICS_PORT)
+    + " (HOST defaults to 127.0.0.1)\n"
+    + "     like window/json/dzen, it shows the daemon's readings if it is running\n"
     )
 def getCommand(arg, commands):
   for key in commands:
@@ -114,7 +349,11 @@ def main():
     "window": ["-w", "--window", "window"],
     "json": ["-j", "--json", "json"],
     "dzen": ["-d", "--dzen", "dzen"],
-    "prefs": ["-p", "--prefs", "prefs"]
+    "prefs": ["-p", "--prefs", "prefs"],
+    "daemon": ["-D", "--daemon", "daemon"],
+    "record": ["-r", "--record", "record"],
+    "stats": ["-s", "--stats", "stats"],
+    "export": ["-e", "--export", "export"]
   }
 
   if len(sys.argv) >= 2:
@@ -124,6 +363,7 @@ def main():
     print(usage(sys.argv[0], commands))
 
   if cmd == 'window' and len(args) == 0:
+    GTK_MOD = getGtkMod()
     window = GTK_MOD.GTK.Window(GTK_MOD.WINDOW_TOPLEVEL)
     window.set_title("TPBattStat")
     tpbattstat = TPBattStat("gtk")
@@ -146,8 +386,48 @@ def main():
 
     tpbattstat = TPBattStat(cmd, forceDelay=delay, forceIconSize=iconSize)
     tpbattstat.startUpdate()
-    GTK_MOD.GTK.main()
+    tpbattstat.loop.run()
+    sys.exit()
+  elif cmd == 'daemon' and 0 <= len(args) and len(args) <= 1:
+    delay = None
+    if len(args) > 0:
+      delay = args[0]
+
+    tpbattstat = TPBattStat(cmd, forceDelay=delay)
+    tpbattstat.startUpdate()
+    try:
+      tpbattstat.loop.run()
+    finally:
+      tpbattstat.server.close()
+    sys.exit()
+  elif cmd == 'record' and 1 <= len(args) and len(args) <= 3:
+    interval = RECORD_INTERVAL
+    duration = None
+    if len(args) > 1:
+      interval = int(args[1])
+    if len(args) > 2:
+      duration = float(args[2])
+
+    prefs = Prefs()
+    prefs.update()
+    record(args[0], interval, duration, prefs['sysfsRoot'].rstrip('/'))
+  elif cmd == 'export' and 0 <= len(args) and len(args) <= 2:
+    addr = None
+    delay = None
+    if len(args) > 0:
+      addr = args[0]
+    if len(args) > 1:
+      delay = args[1]
+
+    tpbattstat = TPBattStat(cmd, forceDelay=delay, exportAddr=addr)
+    tpbattstat.startUpdate()
+    try:
+      tpbattstat.loop.run()
+    finally:
+      tpbattstat.exporter.close()
     sys.exit()
+  elif cmd == 'stats' and (args == [] or args == ['json']):
+    return printStats(asJson=len(args) > 0)
   else:
     print(usage(sys.argv[0], commands))
 
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+##########################################################################
+# TPBattStatApplet v0.1
+# Copyright 2011 Elliot Wolk
+##########################################################################
+# This file is part of TPBattStatApplet.
+#
+# TPBattStatApplet is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# TPBattStatApplet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TPBattStatApplet. If not, see <http://www.gnu.org/licenses/>.
+##########################################################################
+
+
+import socket
+import errno
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+def parseUevent(data):
+  fields = data.split(b'\0')
+  header = fields[0].decode('utf-8', 'replace')
+  if '@' not in header:
+    return None
+  (action, devpath) = header.split('@', 1)
+  uevent = {'ACTION': action, 'DEVPATH': devpath}
+  for field in fields[1:]:
+    keyVal = field.decode('utf-8', 'replace').split('=', 1)
+    if len(keyVal) == 2:
+      uevent[keyVal[0]] = keyVal[1]
+  return uevent
+
+class UeventMonitor():
+  def __init__(self, subsystem='power_supply', sock=None):
+    self.subsystem = subsystem
+    if sock == None:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+        NETLINK_KOBJECT_UEVENT)
+      sock.bind((0, UEVENT_GROUP_KERNEL))
+    sock.setblocking(False)
+    self.sock = sock
+  def fileno(self):
+    return self.sock.fileno()
+  def close(self):
+    self.sock.close()
+  def readEvents(self):
+    events = []
+    while True:
+      try:
+        data = self.sock.recv(8192)
+      except socket.error as e:
+        if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+          break
+        elif e.errno == errno.ENOBUFS:
+          #events were dropped; report one so the caller rereads everything
+          events.append({'ACTION': 'change', 'SUBSYSTEM': self.subsystem})
+          continue
+        raise
+      if len(data) == 0:
+        break
+      uevent = parseUevent(data)
+      if uevent != None and uevent.get('SUBSYSTEM') == self.subsystem:
+        events.append(uevent)
+    return events